@@ -0,0 +1,383 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+from bus import WorkerBus, create_mesh
+from fragments import Reassembler, reseed_message_ids, split_message
+from history import REPLAY_BATCH, MessageHistory
+from metrics import WIDTH_BUCKETS, Delivery, Metrics, SampledLog, clients_report, handle_admin_command
+from outbound import DROP_OLDEST, OUTBOUND_QUEUE_SIZE, OutboundQueue
+from protocol import ENCODING, FrameDecoder, ProtocolError, encode_text, parse_handshake
+from rooms import RoomIndex, parse_room_command
+from server_options import SERVER_PORT, configure, server_arguments
+
+tcp_clients = {}  # {address: TcpClientProtocol}
+udp_clients = set()
+clients_nicknames = {}
+rooms = RoomIndex()
+tcp_history = MessageHistory()
+udp_history = MessageHistory()
+
+metrics = Metrics()
+logger = logging.getLogger("chat")
+tcp_log = SampledLog(logger)
+udp_log = SampledLog(logger)
+
+# with several workers, nicknames and rooms of all clients are replicated over the bus,
+# while tcp_clients and udp_clients only hold clients connected to this worker
+bus = None
+udp_transport = None
+
+TCP_BACKLOG = 1024
+
+
+def publish(message):
+    if bus is not None:
+        bus.publish(message)
+
+
+def change_room(address, room):
+    if address not in clients_nicknames:
+        return
+    rooms.join(address, room)
+    publish(("room", address, room))
+    print(f"[Rooms] {address} is now in room {room}")
+    if address in tcp_clients:
+        replay_history(tcp_clients[address], room)
+
+
+def stream_replay(send, messages, start=0):
+    # one batch per loop iteration, so live messages don't wait for a long replay
+    end = start + REPLAY_BATCH
+    for message in messages[start:end]:
+        send(message)
+    if end < len(messages):
+        asyncio.get_running_loop().call_soon(stream_replay, send, messages, end)
+
+
+def replay_history(client, room):
+    def send_datagrams(datagrams):
+        if client.address in udp_clients:
+            for datagram in datagrams:
+                udp_transport.sendto(datagram, client.address)
+
+    stream_replay(client.queue_frame, tcp_history.replay(room))
+    stream_replay(send_datagrams, udp_history.replay(room))
+
+
+def deliver_tcp(room, sender_address, frame, received):
+    tcp_history.add(room, frame, len(frame))
+    recipients = [tcp_clients[address] for address in rooms.members_of(room)
+                  if address != sender_address and address in tcp_clients]
+    metrics.observe("tcp_fan_out_width", len(recipients), WIDTH_BUCKETS)
+    if not recipients:
+        return
+
+    delivery = Delivery(metrics, "tcp_delivery_seconds", received, len(recipients))
+    for client in recipients:
+        client.queue_frame(frame, delivery)
+
+
+def deliver_udp(room, sender_address, datagrams, received):
+    size = sum(map(len, datagrams))
+    udp_history.add(room, datagrams, size)
+    recipients = [client_address for client_address in rooms.members_of(room)
+                  if client_address != sender_address and client_address in udp_clients]
+    metrics.observe("udp_fan_out_width", len(recipients), WIDTH_BUCKETS)
+    if not recipients:
+        return
+
+    for client_address in recipients:
+        for datagram in datagrams:
+            udp_transport.sendto(datagram, client_address)
+    metrics.incr("udp_messages_out", len(recipients))
+    metrics.incr("udp_bytes_out", size * len(recipients))
+    metrics.observe("udp_delivery_seconds", time.perf_counter() - received)
+
+
+def report_clients():
+    return clients_report(tcp_clients, lambda address, client: client.nickname, rooms.room_of)
+
+
+async def handle_admin(reader, writer):
+    try:
+        command = await reader.readline()
+        writer.write(handle_admin_command(command.decode(errors='replace'), metrics, (tcp_log, udp_log),
+                                          report_clients).encode())
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def handle_bus_message(message):
+    kind, address = message[0], message[1]
+    if kind == "hello":
+        clients_nicknames[address] = message[2]
+        rooms.join(address)
+    elif kind == "bye":
+        clients_nicknames.pop(address, None)
+        rooms.leave(address)
+    elif kind == "room":
+        rooms.join(address, message[2])
+        if address in tcp_clients:
+            replay_history(tcp_clients[address], message[2])
+    elif kind == "tcp":
+        deliver_tcp(message[2], address, message[3], time.perf_counter())
+    elif kind == "udp":
+        deliver_udp(message[2], address, message[3], time.perf_counter())
+
+
+class TcpClientProtocol(asyncio.Protocol):
+    """One instance per TCP connection, all of them driven by the same event loop"""
+
+    def __init__(self, queue_size=OUTBOUND_QUEUE_SIZE, overflow_policy=DROP_OLDEST):
+        self.transport = None
+        self.address = None
+        self.nickname = None
+        self.decoder = FrameDecoder()
+        self.outbound = OutboundQueue(queue_size, overflow_policy, on_drop=self.drop_frame)
+        self.paused = False
+        self.flush_scheduled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info("peername")
+        tcp_clients[self.address] = self
+        udp_clients.add(self.address)
+        rooms.join(self.address)
+
+    def data_received(self, data):
+        received = time.perf_counter()
+        try:
+            for payload in self.decoder.feed(data):
+                if self.nickname is None:
+                    self.handle_handshake(payload)
+                else:
+                    self.handle_message(payload, received)
+        except (ProtocolError, UnicodeDecodeError) as ex:
+            print(f"Error: {ex}. Client address: {self.address}")
+            self.transport.close()
+
+    def handle_handshake(self, payload):
+        self.nickname = parse_handshake(payload)
+        clients_nicknames[self.address] = self.nickname
+        publish(("hello", self.address, self.nickname))
+        print(f"Connected user: {self.nickname} on address {self.address}")
+        replay_history(self, rooms.room_of(self.address))
+
+    def handle_message(self, payload, received):
+        metrics.incr("tcp_messages_in")
+        metrics.incr("tcp_bytes_in", len(payload))
+        msg = payload.decode(ENCODING)
+
+        room = parse_room_command(msg)
+        if room is not None:
+            self.queue_frame(encode_text(f"Server: you are in room {room}"))
+            change_room(self.address, room)
+            return
+
+        if tcp_log.enabled:
+            tcp_log.log("[TCP-server] Received message from %s: %s", self.nickname, msg)
+        # encoded once, the same frame is queued for every peer in the room
+        frame = encode_text(f"{self.nickname}: {msg}")
+        room = rooms.room_of(self.address)
+        deliver_tcp(room, self.address, frame, received)
+        publish(("tcp", self.address, room, frame))
+
+    def queue_frame(self, frame, delivery=None):
+        if self.transport.is_closing():
+            if delivery:
+                delivery.done(delivered=False)
+            return
+        if not self.outbound.put((frame, delivery)):
+            print(f"Client {self.address} is too slow, disconnecting")
+            metrics.incr("tcp_slow_disconnects")
+            self.transport.abort()
+            return
+        if not self.paused and not self.flush_scheduled:
+            # frames queued during this loop iteration go out in a single write
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.paused or self.transport.is_closing():
+            return
+        items = self.outbound.take_all()
+        frames = [frame for frame, _ in items]
+        self.transport.writelines(frames)
+
+        metrics.incr("tcp_messages_out", len(frames))
+        metrics.incr("tcp_bytes_out", sum(map(len, frames)))
+        for _, delivery in items:
+            if delivery:
+                delivery.done()
+
+    @staticmethod
+    def drop_frame(item):
+        metrics.incr("tcp_dropped")
+        if item[1]:
+            item[1].done(delivered=False)
+
+    def pause_writing(self):
+        # the socket buffer is full, new frames wait in the bounded outbound queue
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            print(f"Error: {exc}. Client address: {self.address}")
+            metrics.incr("tcp_send_errors")
+        self.outbound.drop_all()
+        print(f"Closing connection for address: {self.address} "
+              f"(queued {self.outbound.queued}, dropped {self.outbound.dropped})")
+        tcp_clients.pop(self.address, None)
+        udp_clients.discard(self.address)
+        clients_nicknames.pop(self.address, None)
+        rooms.leave(self.address)
+        publish(("bye", self.address))
+
+
+class UdpRelayProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.reassembler = Reassembler()
+
+    def datagram_received(self, data, address):
+        received = time.perf_counter()
+        metrics.incr("udp_bytes_in", len(data))
+        data = self.reassembler.add(data, address)
+        if data is None:
+            return
+        metrics.incr("udp_messages_in")
+        msg = data.decode('cp1250', errors='replace')
+
+        room = parse_room_command(msg)
+        if room is not None:
+            change_room(address, room)
+            return
+
+        nickname = clients_nicknames.get(address, f"Unknown-{address}")
+
+        if udp_log.enabled:
+            udp_log.log("[UDP-server] Received message from %s: %s", nickname, msg)
+
+        try:
+            # split once, the same datagrams go to every recipient
+            datagrams = split_message(f"{nickname}: {msg}".encode('cp1250', errors='replace'))
+        except ValueError as exception:
+            print(f"Error relaying UDP message from {nickname}: {exception}")
+            return
+        room = rooms.room_of(address)
+        deliver_udp(room, address, datagrams, received)
+        publish(("udp", address, room, datagrams))
+
+    def error_received(self, exc):
+        metrics.incr("udp_send_errors")
+        print(f"Error sending UDP message: {exc}")
+
+
+async def serve(port=SERVER_PORT, queue_size=OUTBOUND_QUEUE_SIZE, overflow_policy=DROP_OLDEST, bus_socks=(),
+                admin_port=None):
+    global bus, udp_transport
+    loop = asyncio.get_running_loop()
+    # every worker binds the same port, the kernel spreads connections and datagrams between them
+    reuse_port = bool(bus_socks)
+
+    if bus_socks:
+        bus = WorkerBus(bus_socks, handle_bus_message)
+        await bus.start()
+
+    # TCP socket
+    client_factory = functools.partial(TcpClientProtocol, queue_size, overflow_policy)
+    server_tcp = await loop.create_server(client_factory, '0.0.0.0', port, family=socket.AF_INET,
+                                          backlog=TCP_BACKLOG, reuse_port=reuse_port)
+
+    # UDP socket
+    udp_transport, _ = await loop.create_datagram_endpoint(UdpRelayProtocol, local_addr=('0.0.0.0', port),
+                                                           family=socket.AF_INET, reuse_port=reuse_port)
+
+    # admin socket, only reachable from this host
+    server_admin = None
+    if admin_port:
+        server_admin = await asyncio.start_server(handle_admin, '127.0.0.1', admin_port)
+        print(f"Admin socket on 127.0.0.1:{admin_port}")
+
+    print(f'SERVER STARTED (worker {os.getpid()})' if bus_socks else 'SERVER STARTED')
+
+    try:
+        async with server_tcp:
+            await server_tcp.serve_forever()
+    finally:
+        udp_transport.close()
+        if server_admin is not None:
+            server_admin.close()
+        if bus is not None:
+            bus.close()
+
+
+def run_worker(index, bus_socks, other_socks, args):
+    # sockets of the other workers were inherited from the parent
+    for sock in other_socks:
+        sock.close()
+    reseed_message_ids()
+    # every worker has its own admin port
+    admin_port = args.admin_port + index if args.admin_port else None
+    try:
+        asyncio.run(serve(args.port, args.queue_size, args.overflow_policy, bus_socks, admin_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(args):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("Several workers need SO_REUSEPORT, which is not available on this platform")
+
+    mesh = create_mesh(args.workers)
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for index, bus_socks in enumerate(mesh):
+        other_socks = [sock for other, socks in enumerate(mesh) if other != index for sock in socks]
+        worker = context.Process(target=run_worker, args=(index, bus_socks, other_socks, args))
+        worker.start()
+        workers.append(worker)
+
+    for socks in mesh:
+        for sock in socks:
+            sock.close()
+
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+
+def main():
+    parser = server_arguments("Single-threaded asyncio chat server")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the server port")
+    args = parser.parse_args()
+    configure(args, (tcp_history, udp_history), (tcp_log, udp_log))
+
+    try:
+        if args.workers > 1:
+            run_workers(args)
+            return
+        asyncio.run(serve(args.port, args.queue_size, args.overflow_policy, admin_port=args.admin_port))
+    except KeyboardInterrupt:
+        print("Server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""Load generator for the chat servers.
+
+Starts a server engine on a local port, connects simulated clients (TCP handshake plus UDP socket
+on the same port, like client.py), sends messages at the given rate and measures how long they take
+to reach every other client. One JSON line with configuration and results is appended to --output.
+
+    python benchmark.py --engine threads --clients 50
+    python benchmark.py --engine asyncio --workers 4 --clients 2000 --senders 100 --rate 1000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from fragments import Reassembler, split_message
+from protocol import ENCODING, FrameDecoder, ProtocolError, encode_handshake, encode_text
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ENGINES = {"threads": "server.py", "asyncio": "async_server.py"}
+
+SERVER_HOST = "127.0.0.1"
+BENCH_PORT = 9109
+BENCH_MARKER = b"bench"
+CONNECT_BATCH = 50
+
+message_ids = itertools.count()
+
+
+class TransportStats:
+    def __init__(self):
+        self.sent = {}  # {message_id: send time}
+        self.last_delivery = {}  # {message_id: time of the latest delivery}
+        self.latencies = []
+        self.received_bytes = 0
+
+    def record(self, payload, received):
+        self.received_bytes += len(payload)
+        # payload is "nickname: bench <message_id> <padding>"
+        parts = payload.split(b" ", 3)
+        if len(parts) < 3 or parts[1] != BENCH_MARKER:
+            return
+        message_id = int(parts[2])
+        sent = self.sent.get(message_id)
+        if sent is None:
+            return
+        self.latencies.append(received - sent)
+        self.last_delivery[message_id] = received
+
+    def summary(self, recipients, duration):
+        expected = len(self.sent) * recipients
+        fan_out = [self.last_delivery[message_id] - sent for message_id, sent in self.sent.items()
+                   if message_id in self.last_delivery]
+        return {
+            "messages_sent": len(self.sent),
+            "deliveries": len(self.latencies),
+            "delivery_ratio": len(self.latencies) / expected if expected else None,
+            "deliveries_per_second": len(self.latencies) / duration,
+            "received_bytes": self.received_bytes,
+            "latency_ms": percentiles(self.latencies),
+            "fan_out_latency_ms": percentiles(fan_out),
+        }
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+
+    return {"p50": at(0.5), "p99": at(0.99), "p999": at(0.999), "max": round(values[-1] * 1000, 3)}
+
+
+class BenchTcpClient(asyncio.Protocol):
+    def __init__(self, stats):
+        self.stats = stats
+        self.decoder = FrameDecoder()
+
+    def data_received(self, data):
+        received = time.perf_counter()
+        try:
+            for payload in self.decoder.feed(data):
+                self.stats.record(payload, received)
+        except ProtocolError as ex:
+            print(f"Error: {ex}")
+
+
+class BenchUdpClient(asyncio.DatagramProtocol):
+    def __init__(self, stats):
+        self.stats = stats
+        self.reassembler = Reassembler()
+
+    def datagram_received(self, data, address):
+        received = time.perf_counter()
+        message = self.reassembler.add(data, address)
+        if message is not None:
+            self.stats.record(message, received)
+
+
+async def connect_client(index, port, tcp_stats, udp_stats):
+    loop = asyncio.get_running_loop()
+    tcp, _ = await loop.create_connection(lambda: BenchTcpClient(tcp_stats), SERVER_HOST, port)
+    tcp.write(encode_handshake(f"client-{index}"))
+    # the server knows UDP senders by the address of their TCP connection
+    udp, _ = await loop.create_datagram_endpoint(lambda: BenchUdpClient(udp_stats),
+                                                 local_addr=tcp.get_extra_info("sockname"))
+    return tcp, udp
+
+
+async def send_loop(send, stats, rate, deadline):
+    interval = 1 / rate
+    next_send = time.perf_counter()
+    while next_send < deadline:
+        message_id = next(message_ids)
+        stats.sent[message_id] = time.perf_counter()
+        send(message_id)
+        next_send += interval
+        await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+
+async def run_load(args, tcp_stats, udp_stats, server):
+    clients = []
+    for start in range(0, args.clients, CONNECT_BATCH):
+        indexes = range(start, min(start + CONNECT_BATCH, args.clients))
+        clients += await asyncio.gather(*(connect_client(index, args.port, tcp_stats, udp_stats)
+                                          for index in indexes))
+    print(f"Connected {len(clients)} clients")
+    await asyncio.sleep(args.warmup)
+
+    padding = "x" * args.message_size
+    picture = "#" * args.picture_size
+    senders = clients[:args.senders]
+    server_address = (SERVER_HOST, args.port)
+
+    def tcp_sender(tcp):
+        return lambda message_id: tcp.write(encode_text(f"bench {message_id} {padding}"))
+
+    def udp_sender(udp):
+        def send(message_id):
+            for datagram in split_message(f"bench {message_id} {picture}".encode(ENCODING)):
+                udp.sendto(datagram, server_address)
+        return send
+
+    before = process_usage(server.pid)
+    started = time.perf_counter()
+    deadline = started + args.duration
+    loops = [send_loop(tcp_sender(tcp), tcp_stats, args.rate / len(senders), deadline) for tcp, _ in senders]
+    if args.udp_rate:
+        loops += [send_loop(udp_sender(udp), udp_stats, args.udp_rate / len(senders), deadline)
+                  for _, udp in senders]
+    await asyncio.gather(*loops)
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+    after = process_usage(server.pid)
+
+    for tcp, udp in clients:
+        tcp.close()
+        udp.close()
+
+    return elapsed, before, after
+
+
+def process_tree(pid):
+    """pid and all its descendants, read from /proc (Linux only)"""
+    pids = [pid]
+    for current in pids:
+        for task in os.listdir(f"/proc/{current}/task"):
+            with open(f"/proc/{current}/task/{task}/children") as children:
+                pids += [int(child) for child in children.read().split()]
+    return pids
+
+
+def process_usage(pid):
+    """CPU seconds, peak RSS and context switches of the server and its workers, None if unknown"""
+    try:
+        usage = {"cpu_seconds": 0.0, "peak_rss_kb": 0, "context_switches": 0}
+        ticks = os.sysconf("SC_CLK_TCK")
+        for current in process_tree(pid):
+            with open(f"/proc/{current}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+                usage["cpu_seconds"] += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        usage["peak_rss_kb"] += int(line.split()[1])
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/status") as status:
+                    for line in status:
+                        if line.startswith(("voluntary_ctxt_switches:", "nonvoluntary_ctxt_switches:")):
+                            usage["context_switches"] += int(line.split()[1])
+        return usage
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def raise_open_files_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+def start_server(args):
+    command = [sys.executable, os.path.join(BASE_DIR, ENGINES[args.engine]),
+               "--port", str(args.port), "--replay-count", "0", "--admin-port", "0"]
+    if args.engine == "asyncio" and args.workers > 1:
+        command += ["--workers", str(args.workers)]
+
+    # server prints every message, which would measure the terminal instead of the server
+    server = subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL, start_new_session=True)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((SERVER_HOST, args.port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    stop_server(server)
+    raise SystemExit("Server did not start")
+
+
+def stop_server(server):
+    # the whole process group, so workers of the asyncio engine are stopped too
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chat server load and fan-out latency benchmark")
+    parser.add_argument("--engine", choices=ENGINES, default="asyncio")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of the asyncio engine")
+    parser.add_argument("--port", type=int, default=BENCH_PORT)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10, help="how many of the clients send messages")
+    parser.add_argument("--rate", type=float, default=100, help="TCP messages per second from all senders")
+    parser.add_argument("--udp-rate", type=float, default=0, help="UDP pictures per second from all senders")
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--picture-size", type=int, default=2048)
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds between connecting and sending")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for messages still on the way")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="file the JSON result line is added to")
+    args = parser.parse_args()
+    args.senders = max(1, min(args.senders, args.clients))
+    return args
+
+
+def main():
+    args = parse_args()
+    raise_open_files_limit()
+
+    tcp_stats = TransportStats()
+    udp_stats = TransportStats()
+
+    server = start_server(args)
+    try:
+        elapsed, before, after = asyncio.run(run_load(args, tcp_stats, udp_stats, server))
+    finally:
+        stop_server(server)
+
+    server_usage = None
+    if before and after:
+        server_usage = {
+            "cpu_percent": round((after["cpu_seconds"] - before["cpu_seconds"]) / elapsed * 100, 1),
+            "peak_rss_kb": after["peak_rss_kb"],
+            "context_switches": after["context_switches"] - before["context_switches"],
+        }
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "tcp": tcp_stats.summary(args.clients - 1, elapsed),
+        "udp": udp_stats.summary(args.clients - 1, elapsed) if args.udp_rate else None,
+        "server": server_usage,
+    }
+
+    print(json.dumps(result, indent=2))
+    with open(args.output, "a") as output:
+        output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
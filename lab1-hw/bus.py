@@ -0,0 +1,61 @@
+import asyncio
+import pickle
+import socket
+
+from protocol import FrameDecoder, ProtocolError, encode_frame
+
+# Worker processes of one server are connected with a full mesh of unix socket pairs.
+# Messages are pickled tuples in the usual length-prefixed frames. The sockets never
+# leave the host and are only shared between processes forked from the same parent.
+
+
+def create_mesh(workers):
+    """Return list of sockets for every worker, one socket for each other worker"""
+    mesh = [[] for _ in range(workers)]
+    for first in range(workers):
+        for second in range(first + 1, workers):
+            first_sock, second_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            mesh[first].append(first_sock)
+            mesh[second].append(second_sock)
+    return mesh
+
+
+class BusPeerProtocol(asyncio.Protocol):
+    def __init__(self, handler):
+        self.handler = handler
+        self.decoder = FrameDecoder()
+
+    def data_received(self, data):
+        try:
+            for payload in self.decoder.feed(data):
+                self.handler(pickle.loads(payload))
+        except ProtocolError as ex:
+            print(f"[Bus] Error: {ex}")
+
+    def connection_lost(self, exc):
+        print("[Bus] Connection to another worker lost")
+
+
+class WorkerBus:
+    """Broadcast messages to all other workers of the server"""
+
+    def __init__(self, socks, handler):
+        self.socks = socks
+        self.handler = handler
+        self.transports = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        for sock in self.socks:
+            transport, _ = await loop.create_connection(lambda: BusPeerProtocol(self.handler), sock=sock)
+            self.transports.append(transport)
+
+    def publish(self, message):
+        frame = encode_frame(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+        for transport in self.transports:
+            if not transport.is_closing():
+                transport.write(frame)
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
@@ -1,15 +1,8 @@
-import socket
-import struct
-import threading
 from art import art
 
-close_flag = False
+from client_engine import ChatClient, ClientLoop
 
-SERVER_IP = "127.0.0.1"
-SERVER_PORT = 9009
-
-MULTICAST_GROUP = "229.1.2.3"
-MULTICAST_PORT = 9000
+chat_mode = False
 
 
 def generate_random_ascii():
@@ -24,76 +17,46 @@ def print_action_list():
     print("Q - Exit")
 
 
-def send_udp_picture(client_udp):
-    ascii_art = generate_random_ascii()
-    client_udp.sendto(ascii_art.encode('cp1250'), (SERVER_IP, SERVER_PORT))
+def send_udp_picture(client):
+    client.send_udp(generate_random_ascii())
     print("[UDP] Sent ASCII Art to the server")
 
 
-def send_multicast_picture(client_multicast, user_nick):
-    ascii_art = generate_random_ascii()
-    message = f"{user_nick}: {ascii_art}"
-    client_multicast.sendto(message.encode('cp1250'), (MULTICAST_GROUP, MULTICAST_PORT))
+def send_multicast_picture(client):
+    client.send_multicast(generate_random_ascii())
     print("[Multicast] Sent ASCII Art to the multicast group")
 
 
-def send_text_message(client):
-    print("*** Chat mode activated. Type '/menu' to go back to menu")
-    print("Enter your message:")
-    while True:
-        msg_input = input()
-        if msg_input.strip().lower() == '/menu':
+def handle_input(client, loop, line):
+    global chat_mode
+
+    if chat_mode:
+        if line.strip().lower() == '/menu':
+            chat_mode = False
             print("\nWe are back to menu. Enter your choice: ")
             return
-        client.sendall(bytes(msg_input, 'cp1250'))
-
-
-def receive_tcp_messages(client):
-    global close_flag
-    while not close_flag:
-        try:
-            msg = client.recv(1024).decode('cp1250')
-            if not msg:
-                break
-            print(f"[TCP] {msg}")
-        except Exception as e:
-            print(f"Error receiving TCP message: {e}")
-            break
-
-    print("Receive TCP thread exiting...")
-
-
-def receive_udp_messages(client_udp):
-    global close_flag
-    while not close_flag:
-        try:
-            msg, _ = client_udp.recvfrom(1024)
-            print(f"[UDP]: {msg.decode('cp1250')}")
-        except Exception as e:
-            print(f"Error receiving UDP message: {e}")
-            break
-
-    print("Receive UDP thread exiting...")
-
-
-def receive_multicast_messages(client_multicast, user_nick):
-    global close_flag
-    while not close_flag:
-        try:
-            msg, _ = client_multicast.recvfrom(1024)
-            message = msg.decode('cp1250')
-            if not message.startswith(f"{user_nick}:"):
-                print(f"[Multicast]: {message}")
-        except Exception as e:
-            print(f"Error receiving multicast message: {e}")
-            break
-
-    print("Receive Multicast thread exiting...")
+        client.send_text(line)
+        return
+
+    choice = line.strip().upper()
+
+    if choice == 'T':
+        chat_mode = True
+        print("*** Chat mode activated. Type '/menu' to go back to menu")
+        print("Type '/join <room>' to change room or '/leave' to go back to the default room")
+        print("Enter your message:")
+    elif choice == 'U':
+        send_udp_picture(client)
+    elif choice == 'M':
+        send_multicast_picture(client)
+    elif choice == 'Q':
+        print("Closing connection...")
+        loop.stop()
+    else:
+        print("Invalid choice. Please try again.")
 
 
 def main():
-    global close_flag
-
     user_nick = ""
     while len(user_nick) < 3:
         user_nick = input("Enter your nickname (at least 3 characters): ").strip()
@@ -102,62 +65,28 @@ def main():
 
     print('CLIENT STARTED')
 
-    # TCP socket
-    client_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_tcp.connect((SERVER_IP, SERVER_PORT))
-    client_tcp.sendall(bytes(user_nick, 'cp1250'))
-
-    # UDP socket
-    tcp_port = client_tcp.getsockname()[1]
-    client_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_udp.bind(('', tcp_port))
+    loop = ClientLoop()
 
-    # Multicast socket
-    client_multicast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    client_multicast.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    client_multicast.bind(('', MULTICAST_PORT))
+    def on_close(_):
+        print("Connection to the server closed")
+        loop.stop()
 
-    # Attach to multicast group
-    multicast_request = struct.pack("4sL", socket.inet_aton(MULTICAST_GROUP), socket.INADDR_ANY)
-    client_multicast.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_request)
+    client = ChatClient(user_nick, on_close=on_close)
+    client.connect()
+    loop.add(client)
 
     print_action_list()
 
     print("Enter your choice: ")
 
-    receive_tcp_thread = threading.Thread(target=receive_tcp_messages, args=(client_tcp,), daemon=True)
-    receive_tcp_thread.start()
-
-    receive_udp_thread = threading.Thread(target=receive_udp_messages, args=(client_udp,), daemon=True)
-    receive_udp_thread.start()
-
-    receive_multicast_thread = threading.Thread(target=receive_multicast_messages, args=(client_multicast, user_nick),
-                                                daemon=True)
-    receive_multicast_thread.start()
-
-    while not close_flag:
-
-        choice = input().strip().upper()
-
-        if choice == 'T':
-            send_text_message(client_tcp)
-        elif choice == 'U':
-            send_udp_picture(client_udp)
-        elif choice == 'M':
-            send_multicast_picture(client_multicast, user_nick)
-        elif choice == 'Q':
-            print("Closing connection...")
-            close_flag = True
-            break
-        else:
-            print("Invalid choice. Please try again.")
-
-    client_tcp.close()
-    client_udp.close()
-    client_multicast.close()
-    receive_tcp_thread.join()
-    receive_udp_thread.join()
-    receive_multicast_thread.join()
+    # TCP, UDP and multicast sockets and the console are all served by one selector loop
+    loop.watch_stdin(lambda line: handle_input(client, loop, line))
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        print("Closing connection...")
+    finally:
+        loop.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,303 @@
+import codecs
+import os
+import selectors
+import socket
+import struct
+import sys
+import threading
+from collections import deque
+
+from fragments import MAX_DATAGRAM_SIZE, Reassembler, split_message
+from protocol import ENCODING, FrameDecoder, ProtocolError, encode_handshake, encode_text
+from rooms import DEFAULT_ROOM, multicast_group, parse_room_command
+
+SERVER_IP = "127.0.0.1"
+SERVER_PORT = 9009
+
+MULTICAST_GROUP = "229.1.2.3"
+MULTICAST_PORT = 9000
+
+TCP = "TCP"
+UDP = "UDP"
+MULTICAST = "Multicast"
+
+RECV_SIZE = 64 * 1024
+DATAGRAMS_PER_EVENT = 64
+
+
+def print_message(client, transport, message):
+    print(f"[TCP] {message}" if transport == TCP else f"[{transport}]: {message}")
+
+
+def multicast_membership(room):
+    return struct.pack("4sL", socket.inet_aton(multicast_group(room, MULTICAST_GROUP)), socket.INADDR_ANY)
+
+
+class ChatClient:
+    """Sockets of one chat user. Never blocks, ClientLoop calls it when one of its sockets is ready."""
+
+    def __init__(self, nickname, server_address=(SERVER_IP, SERVER_PORT), use_multicast=True,
+                 on_message=print_message, on_close=None):
+        self.nickname = nickname
+        self.server_address = server_address
+        self.use_multicast = use_multicast
+        self.on_message = on_message
+        self.on_close = on_close
+        self.room = DEFAULT_ROOM
+        self.tcp = None
+        self.udp = None
+        self.multicast = None
+        self.decoder = FrameDecoder()
+        self.udp_reassembler = Reassembler()
+        self.multicast_reassembler = Reassembler()
+        self.outgoing = bytearray()
+        self.writing = False
+        self.loop = None
+        self.closed = False
+
+    def connect(self):
+        # TCP socket
+        self.tcp = socket.create_connection(self.server_address)
+        self.tcp.setblocking(False)
+        self.outgoing += encode_handshake(self.nickname)
+
+        # UDP socket, the server recognizes it by the port of the TCP connection
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('', self.tcp.getsockname()[1]))
+        self.udp.setblocking(False)
+
+        # Multicast socket
+        if self.use_multicast:
+            self.multicast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.multicast.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.multicast.bind(('', MULTICAST_PORT))
+            self.multicast.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_membership(self.room))
+            self.multicast.setblocking(False)
+
+        self.flush()
+
+    def handlers(self):
+        handlers = [(self.tcp, self.handle_tcp), (self.udp, self.handle_udp)]
+        if self.multicast:
+            handlers.append((self.multicast, self.handle_multicast))
+        return handlers
+
+    def send_text(self, text):
+        room = parse_room_command(text)
+        if room is not None:
+            self.change_multicast_room(room)
+        self.outgoing += encode_text(text)
+        self.flush()
+
+    def send_udp(self, text):
+        self.send_datagrams(self.udp, text, self.server_address)
+
+    def send_multicast(self, text):
+        # room in the message filters out other rooms which happen to share the group
+        message = f"[{self.room}] {self.nickname}: {text}"
+        self.send_datagrams(self.multicast, message, (multicast_group(self.room, MULTICAST_GROUP), MULTICAST_PORT))
+
+    def send_datagrams(self, sock, text, address):
+        try:
+            for datagram in split_message(text.encode(ENCODING)):
+                sock.sendto(datagram, address)
+        except BlockingIOError:
+            # socket buffer is full, datagrams may be lost anyway
+            pass
+
+    def change_multicast_room(self, room):
+        if self.multicast and room != self.room:
+            self.multicast.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, multicast_membership(self.room))
+            self.multicast.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, multicast_membership(room))
+        self.room = room
+
+    def flush(self):
+        if self.closed:
+            return
+        try:
+            sent = self.tcp.send(self.outgoing)
+            del self.outgoing[:sent]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f"Error sending TCP message: {e}")
+            self.connection_lost()
+            return
+
+        if self.loop and self.writing != bool(self.outgoing):
+            self.writing = bool(self.outgoing)
+            self.loop.update(self.tcp, self.handle_tcp, self.writing)
+
+    def handle_tcp(self, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if not mask & selectors.EVENT_READ or self.closed:
+            return
+
+        try:
+            data = self.tcp.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f"Error receiving TCP message: {e}")
+            self.connection_lost()
+            return
+
+        if not data:
+            self.connection_lost()
+            return
+
+        try:
+            for payload in self.decoder.feed(data):
+                self.on_message(self, TCP, payload.decode(ENCODING))
+        except (ProtocolError, UnicodeDecodeError) as e:
+            print(f"Error receiving TCP message: {e}")
+            self.connection_lost()
+
+    def handle_udp(self, mask):
+        if self.closed:
+            return
+        for message in self.receive_datagrams(self.udp, self.udp_reassembler):
+            self.on_message(self, UDP, message)
+
+    def handle_multicast(self, mask):
+        if self.closed:
+            return
+        room_prefix = f"[{self.room}] "
+        for message in self.receive_datagrams(self.multicast, self.multicast_reassembler):
+            if message.startswith(room_prefix) and not message.startswith(f"{room_prefix}{self.nickname}:"):
+                self.on_message(self, MULTICAST, message[len(room_prefix):])
+
+    @staticmethod
+    def receive_datagrams(sock, reassembler):
+        messages = []
+        for _ in range(DATAGRAMS_PER_EVENT):
+            try:
+                datagram, address = sock.recvfrom(MAX_DATAGRAM_SIZE)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # e.g. ICMP port unreachable reported on Windows, the socket is still usable
+                print(f"Error receiving datagram: {e}")
+                break
+            message = reassembler.add(datagram, address)
+            if message is not None:
+                messages.append(message.decode(ENCODING, errors='replace'))
+        return messages
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.loop:
+            self.loop.remove(self)
+        for sock in (self.tcp, self.udp, self.multicast):
+            if sock:
+                sock.close()
+
+    def connection_lost(self):
+        self.close()
+        if self.on_close:
+            self.on_close(self)
+
+
+class ClientLoop:
+    """One selector for any number of ChatClient instances and, optionally, the console"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.clients = set()
+        self.running = False
+        self.callbacks = deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.handle_wakeup)
+
+    def add(self, client):
+        client.loop = self
+        self.clients.add(client)
+        for sock, handler in client.handlers():
+            self.selector.register(sock, selectors.EVENT_READ, handler)
+        client.writing = False
+        client.flush()
+
+    def remove(self, client):
+        self.clients.discard(client)
+        for sock, _ in client.handlers():
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def update(self, sock, handler, writing):
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        self.selector.modify(sock, events, handler)
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.callbacks.append((callback, args))
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            # loop is going to wake up anyway
+            pass
+
+    def handle_wakeup(self, mask):
+        try:
+            while self.wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            callback(*args)
+
+    def watch_stdin(self, on_line):
+        """Call on_line for every line typed on the console"""
+        if sys.platform == "win32":
+            # select() only works with sockets on Windows, so a thread reads the console and hands lines over
+            def read_lines():
+                while True:
+                    try:
+                        line = input()
+                    except EOFError:
+                        self.call_soon_threadsafe(self.stop)
+                        return
+                    self.call_soon_threadsafe(on_line, line)
+
+            threading.Thread(target=read_lines, daemon=True).start()
+            return
+
+        fd = sys.stdin.fileno()
+        decoder = codecs.getincrementaldecoder(sys.stdin.encoding or 'utf-8')(errors='replace')
+        pending = [""]
+
+        def read_stdin(mask):
+            data = os.read(fd, 4096)
+            if not data:
+                self.selector.unregister(fd)
+                self.stop()
+                return
+            *lines, pending[0] = (pending[0] + decoder.decode(data)).split("\n")
+            for line in lines:
+                on_line(line.rstrip("\r"))
+
+        self.selector.register(fd, selectors.EVENT_READ, read_stdin)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            for key, mask in self.selector.select():
+                key.data(mask)
+
+    def stop(self):
+        self.running = False
+        # wakes the loop up when called from another thread
+        self.call_soon_threadsafe(lambda: None)
+
+    def close(self):
+        for client in list(self.clients):
+            client.close()
+        self.selector.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
@@ -0,0 +1,128 @@
+import itertools
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+
+# Messages sent over UDP and multicast are cut into fragments which fit into one datagram:
+# magic, flags, message id, fragment index, fragment count, then a slice of the (maybe compressed) message.
+# Datagrams without the magic are plain single-datagram messages, e.g. room commands.
+
+FRAGMENT_MAGIC = b"\x00\xa7"
+FRAGMENT_HEADER = struct.Struct("!2sBIHH")
+FLAG_COMPRESSED = 0x01
+
+MAX_DATAGRAM_SIZE = 65535
+FRAGMENT_SIZE = 1200 - FRAGMENT_HEADER.size
+MAX_FRAGMENTS = 256
+COMPRESS_THRESHOLD = 512
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+REASSEMBLY_TIMEOUT = 5.0
+MAX_PENDING_MESSAGES = 1024
+
+message_ids = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+
+def reseed_message_ids():
+    """Called in every forked worker, which would otherwise continue the sequence of the parent and of its
+    siblings, and a client reassembling datagrams of two workers would mix their fragments"""
+    global message_ids
+    message_ids = itertools.count(int.from_bytes(os.urandom(4), "big"))
+
+
+def split_message(data: bytes, compress=True) -> list:
+    """Return datagrams carrying the whole message"""
+    flags = 0
+    if compress and len(data) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= FLAG_COMPRESSED
+
+    count = max(1, -(-len(data) // FRAGMENT_SIZE))
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f"Message of {len(data)} bytes needs more than {MAX_FRAGMENTS} fragments")
+
+    message_id = next(message_ids) & 0xffffffff
+    return [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, flags, message_id, index, count)
+            + data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE]
+            for index in range(count)]
+
+
+class PendingMessage:
+    __slots__ = ("flags", "fragments", "received", "started")
+
+    def __init__(self, flags, count, started):
+        self.flags = flags
+        self.fragments = [None] * count
+        self.received = 0
+        self.started = started
+
+
+class Reassembler:
+    """Collect fragments from all senders, incomplete messages are dropped after timeout"""
+
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, max_pending=MAX_PENDING_MESSAGES):
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # {(address, message_id): PendingMessage}, oldest first
+        self.expired = 0
+
+    def add(self, datagram, address):
+        """Return full message when datagram completes it, None otherwise"""
+        if not datagram.startswith(FRAGMENT_MAGIC) or len(datagram) < FRAGMENT_HEADER.size:
+            return datagram
+
+        now = time.monotonic()
+        self.expire(now)
+
+        _, flags, message_id, index, count = FRAGMENT_HEADER.unpack_from(datagram)
+        if not 0 < count <= MAX_FRAGMENTS or index >= count:
+            return None
+
+        if count == 1:
+            return self.decode(flags, datagram[FRAGMENT_HEADER.size:])
+
+        key = (address, message_id)
+        message = self.pending.get(key)
+        if message is None:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.expired += 1
+            message = self.pending[key] = PendingMessage(flags, count, now)
+        elif len(message.fragments) != count:
+            return None
+
+        if message.fragments[index] is None:
+            message.fragments[index] = datagram[FRAGMENT_HEADER.size:]
+            message.received += 1
+
+        if message.received < count:
+            return None
+
+        del self.pending[key]
+        return self.decode(message.flags, b"".join(message.fragments))
+
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        while self.pending:
+            key, message = next(iter(self.pending.items()))
+            if now - message.started < self.timeout:
+                break
+            del self.pending[key]
+            self.expired += 1
+
+    @staticmethod
+    def decode(flags, data):
+        if not flags & FLAG_COMPRESSED:
+            return data
+
+        decompressor = zlib.decompressobj()
+        try:
+            message = decompressor.decompress(data, MAX_MESSAGE_SIZE)
+        except zlib.error:
+            return None
+        # anything left over means the message would be larger than allowed
+        return None if decompressor.unconsumed_tail else message
@@ -0,0 +1,41 @@
+import time
+from collections import deque
+
+HISTORY_SIZE = 1000
+HISTORY_BYTES = 4 * 1024 * 1024
+
+REPLAY_COUNT = 20
+REPLAY_SECONDS = 3600
+REPLAY_BATCH = 16
+
+
+class MessageHistory:
+    """Ring buffer with recent messages of one channel, bounded both by message count and size"""
+
+    def __init__(self, max_messages=HISTORY_SIZE, max_bytes=HISTORY_BYTES,
+                 replay_count=REPLAY_COUNT, replay_seconds=REPLAY_SECONDS):
+        self.messages = deque()  # (timestamp, room, message, size), oldest first
+        self.size = 0
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.replay_count = replay_count
+        self.replay_seconds = replay_seconds
+
+    def add(self, room, message, size):
+        """message is stored as it is sent (encoded frame or list of datagrams), size is its length in bytes"""
+        self.messages.append((time.time(), room, message, size))
+        self.size += size
+        while len(self.messages) > self.max_messages or self.size > self.max_bytes:
+            self.size -= self.messages.popleft()[3]
+
+    def replay(self, room):
+        """Last replay_count messages of the room not older than replay_seconds, oldest first"""
+        since = time.time() - self.replay_seconds
+        selected = []
+        for timestamp, message_room, message, _ in reversed(self.messages):
+            if timestamp < since or len(selected) >= self.replay_count:
+                break
+            if message_room == room:
+                selected.append(message)
+        selected.reverse()
+        return selected
@@ -0,0 +1,153 @@
+import bisect
+import logging
+import threading
+import time
+
+# Counters and histograms of the chat servers, rendered as text lines "name value" for the admin socket.
+
+LATENCY_BUCKETS = [0.00005 * 2 ** i for i in range(18)]  # 50 us .. 6.5 s
+WIDTH_BUCKETS = [2 ** i for i in range(17)]  # 1 .. 65536 recipients
+
+LOG_SAMPLE = 1
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the quantile"""
+        if not self.count:
+            return 0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self, name):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{le="{bound:g}"}} {seen}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_count {self.count}")
+        lines.append(f"{name}_sum {self.sum:g}")
+        for fraction in (0.5, 0.99, 0.999):
+            lines.append(f'{name}{{quantile="{fraction}"}} {self.quantile(fraction):g}')
+        return lines
+
+
+class Metrics:
+    """Counters and histograms shared by all connections. The lock only matters for the thread pool engine."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def render(self):
+        with self.lock:
+            lines = [f"{name} {value}" for name, value in sorted(self.counters.items())]
+            for name, histogram in sorted(self.histograms.items()):
+                lines += histogram.render(name)
+        return "\n".join(lines) + "\n"
+
+
+class Delivery:
+    """Fan-out of one message, its latency is observed when the last recipient has got it"""
+
+    __slots__ = ("metrics", "name", "received", "pending", "last_delivery")
+
+    def __init__(self, metrics, name, received, pending):
+        self.metrics = metrics
+        self.name = name
+        self.received = received
+        self.pending = pending
+        self.last_delivery = None
+
+    def done(self, delivered=True):
+        """delivered is False when the message was dropped for this recipient"""
+        with self.metrics.lock:
+            if delivered:
+                self.last_delivery = time.perf_counter()
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished and self.last_delivery is not None:
+            self.metrics.observe(self.name, self.last_delivery - self.received)
+
+
+class SampledLog:
+    """Logs every n-th message. Call sites check `enabled` first, so a disabled log costs one attribute read."""
+
+    def __init__(self, logger, level=logging.DEBUG, every=LOG_SAMPLE):
+        self.logger = logger
+        self.level = level
+        self.every = max(1, every)
+        self.calls = 0
+        self.enabled = logger.isEnabledFor(level)
+
+    def refresh(self):
+        # has to be called after the log level changes
+        self.enabled = self.logger.isEnabledFor(self.level)
+
+    def log(self, msg, *args):
+        self.calls += 1
+        if self.calls % self.every == 0:
+            self.logger.log(self.level, msg, *args)
+
+
+def clients_report(clients, nickname_of, room_of):
+    """One line per TCP client, clients is {address: client with an outbound queue}"""
+    lines = [f"{address[0]}:{address[1]} {nickname_of(address, client)} {room_of(address)} "
+             f"queued={client.outbound.queued} dropped={client.outbound.dropped} pending={len(client.outbound)}"
+             for address, client in clients.items()]
+    return "\n".join(lines) + "\n"
+
+
+def handle_admin_command(command, metrics, logs, clients_report):
+    """Execute one line received on the admin socket and return the answer"""
+    parts = command.split()
+    if not parts or parts[0] == "metrics":
+        return metrics.render()
+
+    if parts[0] == "clients":
+        return clients_report()
+
+    if parts[0] == "loglevel" and len(parts) == 2:
+        level = logging.getLevelName(parts[1].upper())
+        if not isinstance(level, int):
+            return f"Unknown log level {parts[1]}\n"
+        logging.getLogger().setLevel(level)
+        for log in logs:
+            log.refresh()
+        return f"Log level set to {parts[1].upper()}\n"
+
+    if parts[0] == "sample" and len(parts) == 2 and parts[1].isdigit():
+        for log in logs:
+            log.every = max(1, int(parts[1]))
+        return f"Logging every {max(1, int(parts[1]))}. message\n"
+
+    return "Commands: metrics, clients, loglevel <LEVEL>, sample <N>\n"
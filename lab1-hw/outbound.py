@@ -0,0 +1,54 @@
+from collections import deque
+
+# What to do when a client does not read fast enough and its outbound queue is full
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+OUTBOUND_QUEUE_SIZE = 256
+
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be sent to one client"""
+
+    def __init__(self, max_size=OUTBOUND_QUEUE_SIZE, policy=DROP_OLDEST, on_drop=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.frames = deque()
+        self.max_size = max_size
+        self.policy = policy
+        self.on_drop = on_drop
+        self.queued = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame) -> bool:
+        """Queue frame, False means the client is too slow and has to be disconnected"""
+        if len(self.frames) >= self.max_size:
+            self.dropped += 1
+            if self.policy == DROP_OLDEST:
+                self.drop(self.frames.popleft())
+            else:
+                self.drop(frame)
+                return self.policy == DROP_NEWEST
+
+        self.frames.append(frame)
+        self.queued += 1
+        return True
+
+    def take_all(self) -> list:
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
+
+    def drop_all(self):
+        """Forget frames which are never going to be sent, e.g. after the client disconnected"""
+        for frame in self.take_all():
+            self.drop(frame)
+
+    def drop(self, frame):
+        if self.on_drop:
+            self.on_drop(frame)
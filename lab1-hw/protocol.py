@@ -0,0 +1,111 @@
+import struct
+from collections import deque
+from itertools import islice
+
+# Every TCP message is a frame: 4-byte big-endian payload length followed by the payload.
+# The first frame on a connection is the handshake: magic, protocol version, nickname.
+
+ENCODING = 'cp1250'
+
+PROTOCOL_MAGIC = b"CHAT"
+PROTOCOL_VERSION = 1
+
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1024 * 1024
+
+SENDMSG_MAX_BUFFERS = 64
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(payload: bytes) -> bytes:
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def encode_text(text: str) -> bytes:
+    return encode_frame(text.encode(ENCODING))
+
+
+def encode_handshake(nickname: str) -> bytes:
+    return encode_frame(PROTOCOL_MAGIC + bytes([PROTOCOL_VERSION]) + nickname.encode(ENCODING))
+
+
+def parse_handshake(payload: bytes) -> str:
+    """Return nickname from the handshake frame"""
+    magic_size = len(PROTOCOL_MAGIC)
+    if payload[:magic_size] != PROTOCOL_MAGIC or len(payload) <= magic_size:
+        raise ProtocolError("Invalid handshake")
+
+    version = payload[magic_size]
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+
+    return payload[magic_size + 1:].decode(ENCODING)
+
+
+class FrameDecoder:
+    """Collect stream chunks and cut complete frames out of them"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (size,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if size > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {size} bytes exceeds limit of {MAX_FRAME_SIZE}")
+            end = offset + FRAME_HEADER.size + size
+            if len(self.buffer) < end:
+                break
+            frames.append(bytes(self.buffer[offset + FRAME_HEADER.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+def recv_exactly(sock, size):
+    chunks = bytearray()
+    while len(chunks) < size:
+        chunk = sock.recv(size - len(chunks))
+        if not chunk:
+            return None
+        chunks += chunk
+    return bytes(chunks)
+
+
+def recv_frame(sock):
+    """Read one frame payload from a blocking socket, None when the peer has closed the connection"""
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds limit of {MAX_FRAME_SIZE}")
+
+    return recv_exactly(sock, size) if size else b""
+
+
+def send_frames(sock, frames):
+    """Send already encoded frames in as few system calls as possible"""
+    if not hasattr(sock, "sendmsg"):
+        # no scatter/gather send on this platform (e.g. Windows)
+        sock.sendall(b"".join(frames))
+        return
+
+    buffers = deque(memoryview(frame) for frame in frames if frame)
+    while buffers:
+        sent = sock.sendmsg(list(islice(buffers, SENDMSG_MAX_BUFFERS)))
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers.popleft())
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
@@ -0,0 +1,60 @@
+import zlib
+
+# Every client is in exactly one room. Text starting with a command switches rooms,
+# e.g. "/join music" or "/leave" (back to the default room).
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 32
+
+JOIN_COMMAND = "/join"
+LEAVE_COMMAND = "/leave"
+
+
+def parse_room_command(msg: str):
+    """Return room the client wants to be in, None if msg is not a room command"""
+    parts = msg.strip().split()
+    if not parts:
+        return None
+    if parts[0] == LEAVE_COMMAND and len(parts) == 1:
+        return DEFAULT_ROOM
+    if parts[0] == JOIN_COMMAND and len(parts) == 2 and len(parts[1]) <= MAX_ROOM_NAME:
+        return parts[1]
+    return None
+
+
+def multicast_group(room: str, default_group: str) -> str:
+    """Every room has its own multicast group, so hosts outside the room don't receive its datagrams"""
+    if room == DEFAULT_ROOM:
+        return default_group
+    digest = zlib.crc32(room.encode('utf-8'))
+    return f"239.{(digest >> 16) & 0xff}.{(digest >> 8) & 0xff}.{digest & 0xff}"
+
+
+class RoomIndex:
+    """Room name -> members and member -> room name, so fan-out only touches members of one room"""
+
+    def __init__(self):
+        self.members = {}  # {room: set(address)}
+        self.rooms = {}  # {address: room}
+
+    def join(self, address, room=DEFAULT_ROOM):
+        self.leave(address)
+        self.rooms[address] = room
+        self.members.setdefault(room, set()).add(address)
+
+    def leave(self, address):
+        room = self.rooms.pop(address, None)
+        if room is None:
+            return None
+
+        members = self.members[room]
+        members.discard(address)
+        if not members:
+            del self.members[room]
+        return room
+
+    def room_of(self, address):
+        return self.rooms.get(address, DEFAULT_ROOM)
+
+    def members_of(self, room):
+        return self.members.get(room, ())
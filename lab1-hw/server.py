@@ -1,71 +1,267 @@
+import logging
 import socket
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
-tcp_clients = []
+from fragments import MAX_DATAGRAM_SIZE, Reassembler, split_message
+from history import MessageHistory
+from metrics import WIDTH_BUCKETS, Delivery, Metrics, SampledLog, clients_report, handle_admin_command
+from outbound import DROP_OLDEST, OUTBOUND_QUEUE_SIZE, OutboundQueue
+from protocol import ENCODING, ProtocolError, encode_text, parse_handshake, recv_frame, send_frames
+from rooms import RoomIndex, parse_room_command
+from server_options import configure, server_arguments
+
+tcp_clients = {}  # {address: TcpPeer}
 udp_clients = set()
 clients_lock = threading.Lock()
 clients_nicknames = {}
+rooms = RoomIndex()
+tcp_history = MessageHistory()
+udp_history = MessageHistory()
+udp_socket = None
+
+metrics = Metrics()
+logger = logging.getLogger("chat")
+tcp_log = SampledLog(logger)
+udp_log = SampledLog(logger)
 
 MAX_THREADS = 10
 
 
-def handle_tcp_client(conn, address):
+class TcpPeer:
+    """Connected TCP client. Its own writer thread drains the outbound queue, so a slow reader delays nobody else."""
+
+    def __init__(self, conn, address, queue_size=OUTBOUND_QUEUE_SIZE, overflow_policy=DROP_OLDEST):
+        self.conn = conn
+        self.address = address
+        self.outbound = OutboundQueue(queue_size, overflow_policy, on_drop=drop_frame)
+        self.ready = threading.Condition()
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+
+    def start(self):
+        self.writer.start()
+
+    def send(self, frame, delivery=None):
+        with self.ready:
+            if self.closed:
+                if delivery:
+                    delivery.done(delivered=False)
+                return
+            if not self.outbound.put((frame, delivery)):
+                print(f"Client {self.address} is too slow, disconnecting")
+                metrics.incr("tcp_slow_disconnects")
+                self.close()
+                return
+            self.ready.notify()
+
+    def close(self):
+        with self.ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.outbound.drop_all()
+            self.ready.notify()
+        try:
+            # wakes up the reader thread of this client, which does the cleanup
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.outbound and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                items = self.outbound.take_all()
+            frames = [frame for frame, _ in items]
+            try:
+                send_frames(self.conn, frames)
+            except OSError as exception:
+                print(f"Error sending message to {self.address}: {exception}")
+                metrics.incr("tcp_send_errors")
+                for item in items:
+                    drop_frame(item)
+                self.close()
+                return
+
+            metrics.incr("tcp_messages_out", len(frames))
+            metrics.incr("tcp_bytes_out", sum(map(len, frames)))
+            for _, delivery in items:
+                if delivery:
+                    delivery.done()
+
+
+def drop_frame(item):
+    metrics.incr("tcp_dropped")
+    if item[1]:
+        item[1].done(delivered=False)
+
+
+def broadcast_tcp(frame, sender_address, received):
+    with clients_lock:
+        room = rooms.room_of(sender_address)
+        tcp_history.add(room, frame, len(frame))
+        peers = [tcp_clients[address] for address in rooms.members_of(room)
+                 if address != sender_address and address in tcp_clients]
+    metrics.observe("tcp_fan_out_width", len(peers), WIDTH_BUCKETS)
+    if not peers:
+        return
+
+    # only queues the frame, sending is done by the writer thread of every peer
+    delivery = Delivery(metrics, "tcp_delivery_seconds", received, len(peers))
+    for peer in peers:
+        peer.send(frame, delivery)
+
+
+def change_room(address, room):
+    with clients_lock:
+        peer = tcp_clients.get(address)
+        if peer:
+            rooms.join(address, room)
+    print(f"[Rooms] {address} is now in room {room}")
+    if peer:
+        replay_history(peer, room)
+
+
+def replay_history(peer, room):
+    with clients_lock:
+        frames = tcp_history.replay(room)
+        pictures = udp_history.replay(room)
+
+    # frames are only queued, the writer thread of the peer sends them along with live messages
+    for frame in frames:
+        peer.send(frame)
+    for datagrams in pictures:
+        for datagram in datagrams:
+            udp_socket.sendto(datagram, peer.address)
+
+
+def handle_tcp_client(peer):
+    conn, address = peer.conn, peer.address
     try:
-        nickname = conn.recv(1024).decode('cp1250')
+        nickname = parse_handshake(recv_frame(conn) or b"")
         print(f"Connected user: {nickname} on address {address}")
 
         with clients_lock:
             clients_nicknames[address] = nickname
+            room = rooms.room_of(address)
+        replay_history(peer, room)
 
         while True:
-            msg = conn.recv(1024).decode('cp1250')
-            if not msg:
+            payload = recv_frame(conn)
+            if payload is None:
                 break
-            print(f"[TCP-server] Received message from {nickname}: {msg}")
-            for client in tcp_clients[:]:
-                if client[0] != conn:
-                    try:
-                        client[0].sendall(bytes(f"{nickname}: {msg}", 'cp1250'))
-                    except Exception as exception:
-                        print(f"Error sending message to {client[1]}: {exception}")
-                        if client in tcp_clients:
-                            tcp_clients.remove(client)
-
-    except Exception as ex:
+            received = time.perf_counter()
+            metrics.incr("tcp_messages_in")
+            metrics.incr("tcp_bytes_in", len(payload))
+            msg = payload.decode(ENCODING)
+
+            room = parse_room_command(msg)
+            if room is not None:
+                peer.send(encode_text(f"Server: you are in room {room}"))
+                change_room(address, room)
+                continue
+
+            if tcp_log.enabled:
+                tcp_log.log("[TCP-server] Received message from %s: %s", nickname, msg)
+            # encoded once, the same frame is queued for every peer
+            broadcast_tcp(encode_text(f"{nickname}: {msg}"), address, received)
+
+    except (OSError, ProtocolError, UnicodeDecodeError) as ex:
         print(f"Error: {ex}. Client address: {address}")
     finally:
-        print(f"Closing connection for address: {address}")
-        conn.close()
         with clients_lock:
-            if (conn, address) in tcp_clients:
-                tcp_clients.remove((conn, address))
+            tcp_clients.pop(address, None)
             udp_clients.discard(address)
             clients_nicknames.pop(address, None)
+            rooms.leave(address)
+        peer.close()
+        print(f"Closing connection for address: {address} "
+              f"(queued {peer.outbound.queued}, dropped {peer.outbound.dropped})")
+        conn.close()
 
 
 def handle_udp_messages(server_udp_socket):
+    reassembler = Reassembler()
     while True:
-        buff, address = server_udp_socket.recvfrom(1024)
-        msg = buff.decode('cp1250')
+        buff, address = server_udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+        received = time.perf_counter()
+        metrics.incr("udp_bytes_in", len(buff))
+        data = reassembler.add(buff, address)
+        if data is None:
+            continue
+        metrics.incr("udp_messages_in")
+        msg = data.decode('cp1250', errors='replace')
+
+        room = parse_room_command(msg)
+        if room is not None:
+            change_room(address, room)
+            continue
 
         nickname = clients_nicknames.get(address, f"Unknown-{address}")
 
-        udp_message = f"{nickname}: {msg}"
+        try:
+            # split once, the same datagrams go to every recipient
+            datagrams = split_message(f"{nickname}: {msg}".encode('cp1250', errors='replace'))
+        except ValueError as exception:
+            print(f"Error relaying UDP message from {nickname}: {exception}")
+            continue
 
-        print(f"[UDP-server] Received message from {nickname}: {msg}")
+        if udp_log.enabled:
+            udp_log.log("[UDP-server] Received message from %s: %s", nickname, msg)
 
-        for client_address in udp_clients:
-            if client_address != address:
-                try:
-                    server_udp_socket.sendto(udp_message.encode('cp1250'), client_address)
-                except Exception as exception:
-                    print(f"Error sending UDP message to {client_address}: {exception}")
-                    udp_clients.remove(client_address)
+        size = sum(map(len, datagrams))
+        with clients_lock:
+            room = rooms.room_of(address)
+            udp_history.add(room, datagrams, size)
+            recipients = [client_address for client_address in rooms.members_of(room)
+                          if client_address != address and client_address in udp_clients]
+        metrics.observe("udp_fan_out_width", len(recipients), WIDTH_BUCKETS)
+        if not recipients:
+            continue
+
+        sent = 0
+        for client_address in recipients:
+            try:
+                for datagram in datagrams:
+                    server_udp_socket.sendto(datagram, client_address)
+                sent += 1
+            except Exception as exception:
+                print(f"Error sending UDP message to {client_address}: {exception}")
+                metrics.incr("udp_send_errors")
+                with clients_lock:
+                    udp_clients.discard(client_address)
+        metrics.incr("udp_messages_out", sent)
+        metrics.incr("udp_bytes_out", size * sent)
+        metrics.observe("udp_delivery_seconds", time.perf_counter() - received)
+
+
+def report_clients():
+    with clients_lock:
+        return clients_report(tcp_clients, lambda address, peer: clients_nicknames.get(address), rooms.room_of)
+
+
+def handle_admin(admin_socket):
+    # one command per connection, e.g. `echo metrics | nc 127.0.0.1 9010`
+    while True:
+        conn, _ = admin_socket.accept()
+        with conn:
+            try:
+                command = conn.makefile(encoding='utf-8', errors='replace').readline()
+                conn.sendall(handle_admin_command(command, metrics, (tcp_log, udp_log), report_clients).encode())
+            except OSError as exception:
+                print(f"Error on admin connection: {exception}")
 
 
 def main():
-    server_port = 9009
+    global udp_socket
+    args = server_arguments("Thread pool chat server").parse_args()
+    configure(args, (tcp_history, udp_history), (tcp_log, udp_log))
+    server_port = args.port
 
     # TCP socket
     server_tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -75,6 +271,15 @@ def main():
     # UDP socket
     server_udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     server_udp_socket.bind(('', server_port))
+    udp_socket = server_udp_socket
+
+    # admin socket, only reachable from this host; its own thread so it works even when the pool is busy
+    if args.admin_port:
+        admin_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        admin_socket.bind(('127.0.0.1', args.admin_port))
+        admin_socket.listen(5)
+        threading.Thread(target=handle_admin, args=(admin_socket,), daemon=True).start()
+        print(f"Admin socket on 127.0.0.1:{args.admin_port}")
 
     print('SERVER STARTED')
 
@@ -84,11 +289,14 @@ def main():
         try:
             while True:
                 conn_accepted, address_accepted = server_tcp_socket.accept()
+                peer = TcpPeer(conn_accepted, address_accepted, args.queue_size, args.overflow_policy)
+                peer.start()
                 with clients_lock:
-                    tcp_clients.append((conn_accepted, address_accepted))
+                    tcp_clients[address_accepted] = peer
                     udp_clients.add(address_accepted)
+                    rooms.join(address_accepted)
 
-                executor.submit(handle_tcp_client, conn_accepted, address_accepted)
+                executor.submit(handle_tcp_client, peer)
         except Exception as e:
             print(f"Error: {e}. Can't accept connection")
         finally:
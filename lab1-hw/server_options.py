@@ -0,0 +1,42 @@
+import argparse
+import logging
+
+from history import REPLAY_COUNT, REPLAY_SECONDS
+from metrics import LOG_SAMPLE
+from outbound import DROP_OLDEST, OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICIES
+
+# Command line options and startup settings shared by both server engines.
+
+SERVER_PORT = 9009
+ADMIN_PORT = 9010
+
+
+def server_arguments(description):
+    """Parser with the options of both engines, an engine adds its own before parsing"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="TCP and UDP port of the server")
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="maximum number of frames waiting to be sent to one client")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST,
+                        help="what to do with a client whose outbound queue is full")
+    parser.add_argument("--replay-count", type=int, default=REPLAY_COUNT,
+                        help="how many recent messages a client gets after joining a room")
+    parser.add_argument("--replay-seconds", type=int, default=REPLAY_SECONDS,
+                        help="how old messages replayed after joining a room can be")
+    parser.add_argument("--admin-port", type=int, default=ADMIN_PORT,
+                        help="local port of the admin socket (metrics, clients, loglevel, sample), 0 disables it")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every received message")
+    parser.add_argument("--log-sample", type=int, default=LOG_SAMPLE, help="log only every n-th received message")
+    return parser
+
+
+def configure(args, histories, logs):
+    """Apply the parsed options to the message histories and sampled logs of an engine"""
+    for history in histories:
+        history.replay_count = args.replay_count
+        history.replay_seconds = args.replay_seconds
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(message)s")
+    for log in logs:
+        log.every = max(1, args.log_sample)
+        log.refresh()
@@ -1,6 +1,9 @@
 from datetime import datetime
+from typing import List
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 
+from bs4 import BeautifulSoup
+
 
 def convert_salary(salary_min, salary_max, currency, exchange_rates):
     """Convert salary to EUR"""
@@ -60,3 +63,14 @@ def clean_url_params(url: str) -> str:
     cleaned_query = urlencode(cleaned_params)
     cleaned_url = parsed_url._replace(query=cleaned_query)
     return urlunparse(cleaned_url)
+
+
+def extract_description(description_html: str) -> str:
+    """Text of the paragraphs and list items of an HTML description"""
+    soup = BeautifulSoup(description_html, "html.parser")
+    return "\n\n".join(p.get_text(strip=True) for p in soup.find_all(["p", "li"]))
+
+
+def extract_descriptions(descriptions_html: List[str]) -> List[str]:
+    """Batch of extract_description, runs in the worker processes"""
+    return [extract_description(description_html) for description_html in descriptions_html]
@@ -1,22 +1,59 @@
+import asyncio
+import hashlib
+import importlib.util
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
 import httpx
 from starlette.responses import PlainTextResponse
 
 import helper
-import requests
 import os
 from fastapi import FastAPI, Query
 from typing import List, Optional
+from urllib.parse import urlparse
 from pydantic import BaseModel
 from enum import Enum
 from fastapi.responses import JSONResponse
 from fastapi.templating import Jinja2Templates
-from bs4 import BeautifulSoup
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from starlette.requests import Request
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, description_pool
+    if DESCRIPTION_WORKERS:
+        # forking this process is unsafe once it has threads, the workers come from a clean forkserver process,
+        # started here with all of them before the first request
+        description_pool = ProcessPoolExecutor(DESCRIPTION_WORKERS,
+                                               mp_context=multiprocessing.get_context("forkserver"))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(description_pool, helper.extract_descriptions, [])
+                               for _ in range(DESCRIPTION_WORKERS)))
+    # one client for the whole app, so connections to the APIs are kept alive between searches
+    async with create_http_client() as http_client:
+        # the first rates are loaded before the app accepts searches
+        loaded = await exchange_rates.refresh(http_client)
+        refresher = asyncio.create_task(exchange_rates.run(http_client, loaded))
+        try:
+            yield
+        finally:
+            background = [refresher, *search_cache.refreshing.values(), *search_cache.loading.values()]
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            if description_pool is not None:
+                description_pool.shutdown(cancel_futures=True)
+                description_pool = None
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,17 +72,57 @@ JOBS_API = [
         "url": "https://jobicy.com/api/v2/remote-jobs?geo={country}&industry={industry}&tag={title}",
         "api_name": "jobicy",
         "params": ["country", "industry", "title"],
-        "results": "jobs"
+        "results": "jobs",
+        "description": "jobDescription",
+        "job_url": "url",
+        "timeout": 10,
+        "connect_timeout": 3,
+        "read_timeout": 8,
+        "pool_timeout": 2,
+        "max_connections": 20,
+        "cache_ttl": 600,
+        "cache_stale": 3600
     }
     ,
     {
         "url": "https://jobdataapi.com/api/jobs/?title={title}&location={country}&experience_level={jobLevel}",
         "api_name": "jobdataapi",
         "params": ["country", "title", "jobLevel"],
-        "results": "results"
+        "results": "results",
+        "description": "description",
+        "job_url": "application_url",
+        "timeout": 10,
+        "connect_timeout": 3,
+        "read_timeout": 8,
+        "pool_timeout": 2,
+        "max_connections": 20,
+        "cache_ttl": 300,
+        "cache_stale": 1800
     }
 ]
 
+EXCHANGE_TIMEOUT = httpx.Timeout(5, connect=3)
+EXCHANGE_REFRESH = int(os.environ.get("EXCHANGE_REFRESH", 3600))  # seconds between refreshes of the rates
+EXCHANGE_MAX_AGE = int(os.environ.get("EXCHANGE_MAX_AGE", 24 * 3600))  # older rates are not used any more
+EXCHANGE_RETRY = 60
+# latency budget of the whole search, sources which have not answered by then are reported as timed out
+SEARCH_TIMEOUT = 12
+# parsed results of a source are fresh for its "cache_ttl" seconds, then served for "cache_stale" more seconds
+# while they are fetched again in the background
+SEARCH_CACHE_VACANCIES = int(os.environ.get("SEARCH_CACHE_VACANCIES", 50000))  # least recently used go first
+
+# "timeout" of a source bounds the whole fetch, the others its phases; "max_connections" is the pool of its host
+KEEPALIVE_EXPIRY = 30  # seconds an idle connection is kept open
+# HTTP/2 needs the h2 package (pip install httpx[http2])
+HTTP2 = os.environ.get("HTTP2", "") not in ("", "0")
+
+# HTML descriptions are turned into text in worker processes, 0 parses them on the event loop instead
+DESCRIPTION_WORKERS = int(os.environ.get("DESCRIPTION_WORKERS", os.cpu_count() or 1))
+DESCRIPTION_CACHE_SIZE = int(os.environ.get("DESCRIPTION_CACHE_SIZE", 20000))
+
+http_client: Optional[httpx.AsyncClient] = None  # created in lifespan
+description_pool: Optional[ProcessPoolExecutor] = None  # created in lifespan
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATES_DIR = os.path.join(BASE_DIR, "..", "templates")
 
@@ -99,17 +176,49 @@ def convert_job_level(experience_level):
     return job_level
 
 
-def get_exchange_rates():
-    try:
-        response = requests.get(EXCHANGE_API_URL, timeout=5)
-        data = response.json()
-        return data.get("rates", {})
-    except requests.RequestException:
-        return {}
+class ExchangeRates:
+    """Last good exchange rates, refreshed in the background so searches never wait for them"""
+
+    def __init__(self, refresh_interval, max_age):
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.rates = None
+        self.updated = None  # time.monotonic() of the last successful refresh
+
+    def get(self):
+        """Rates if they are not older than max_age, None otherwise"""
+        if self.rates is None or time.monotonic() - self.updated > self.max_age:
+            return None
+        return self.rates
+
+    async def refresh(self, client):
+        try:
+            response = await client.get(EXCHANGE_API_URL, timeout=EXCHANGE_TIMEOUT)
+            response.raise_for_status()
+            data = response.json()
+            rates = data.get("rates") if isinstance(data, dict) else None
+            if not isinstance(rates, dict) or not rates:
+                raise ValueError(f"no rates in the response: {str(data)[:100]}")
+        except Exception as exception:
+            # the last good rates stay, whatever the API answered
+            print(f"Error refreshing exchange rates: {exception!r}")
+            return False
+        self.rates = rates
+        self.updated = time.monotonic()
+        return True
+
+    async def run(self, client, ok=True):
+        while True:
+            # a failed refresh is retried sooner, the old rates are served meanwhile
+            await asyncio.sleep(self.refresh_interval if ok else EXCHANGE_RETRY)
+            ok = await self.refresh(client)
+
+
+exchange_rates = ExchangeRates(EXCHANGE_REFRESH, EXCHANGE_MAX_AGE)
 
 
-def parse_job_data(api_name, job_data, exchange_rates, country):
-    """ Parse vacancy from some API and normalize data """
+def parse_job_data(api_name, job_data, exchange_rates, country, description_text=None):
+    """ Parse vacancy from some API and normalize data, description_text is extracted here when not given """
 
     if not job_data or not isinstance(job_data, dict):
         return None
@@ -140,9 +249,8 @@ def parse_job_data(api_name, job_data, exchange_rates, country):
             for t in job_data.get("types", [])
         ]
 
-        description_html = job_data.get("description", "")
-        soup = BeautifulSoup(description_html, "html.parser")
-        description_text = "\n\n".join(p.get_text(strip=True) for p in soup.find_all(["p", "li"]))
+        if description_text is None:
+            description_text = helper.extract_description(job_data.get("description", ""))
 
         job_url = job_data.get("application_url", "Unknown")
 
@@ -178,9 +286,8 @@ def parse_job_data(api_name, job_data, exchange_rates, country):
             for t in job_data.get("jobType", [])
         ]
 
-        description_html = job_data.get("jobDescription", "")
-        soup = BeautifulSoup(description_html, "html.parser")
-        description_text = "\n\n".join(p.get_text(strip=True) for p in soup.find_all(["p", "li"]))
+        if description_text is None:
+            description_text = helper.extract_description(job_data.get("jobDescription", ""))
 
         job_url = job_data.get("url", "Unknown")
 
@@ -215,6 +322,206 @@ def parse_job_data(api_name, job_data, exchange_rates, country):
     )
 
 
+def create_http_client():
+    http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+    if HTTP2 and not http2:
+        print("HTTP/2 disabled, the h2 package is not installed")
+
+    # every source gets a pool of its own, so a slow API cannot take the connections of the others
+    mounts = {}
+    for api in JOBS_API:
+        url = urlparse(api["url"])
+        mounts[f"{url.scheme}://{url.netloc}"] = httpx.AsyncHTTPTransport(
+            http2=http2, limits=httpx.Limits(max_connections=api["max_connections"],
+                                             max_keepalive_connections=api["max_connections"],
+                                             keepalive_expiry=KEEPALIVE_EXPIRY))
+    return httpx.AsyncClient(http2=http2, mounts=mounts, timeout=30,
+                             limits=httpx.Limits(keepalive_expiry=KEEPALIVE_EXPIRY))
+
+
+def source_timeout(api):
+    return httpx.Timeout(api["timeout"], connect=api["connect_timeout"], read=api["read_timeout"],
+                         pool=api["pool_timeout"])
+
+
+async def search_source(client, api, url, exchange_rates, country):
+    """Fetch vacancies of one source and parse them as soon as they arrive"""
+    print(f"Fetching jobs from: {url}")
+    response = await client.get(url, timeout=source_timeout(api))
+    response.raise_for_status()
+    data = response.json()
+
+    jobs = data.get(api["results"], [])
+    descriptions = await description_cache.extract(api, jobs)
+    vacancies = []
+    for job, description in zip(jobs, descriptions):
+        vacancy = parse_job_data(api["api_name"], job, exchange_rates, country, description)
+        if vacancy:
+            vacancies.append(vacancy)
+    return vacancies
+
+
+class SearchCache:
+    """Parsed vacancies of a source, keyed by the cleaned upstream URL, with LRU eviction and
+    stale-while-revalidate. Concurrent misses of one URL wait for a single fetch."""
+
+    def __init__(self, max_vacancies):
+        self.max_vacancies = max_vacancies
+        self.entries = OrderedDict()  # {url: (vacancies, time.monotonic() when fetched)}
+        self.vacancies = 0
+        self.loading = {}  # {url: task fetching and parsing it}
+        self.refreshing = {}  # {url: background task refreshing a stale entry}
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "refreshes": 0,
+                      "refresh_errors": 0}
+
+    def get(self, api, url, country):
+        """Cached vacancies, None on a miss. A stale entry is returned and refreshed in the background."""
+        entry = self.entries.get(url)
+        age = time.monotonic() - entry[1] if entry else None
+        if entry is None or age > api["cache_ttl"] + api["cache_stale"]:
+            self.stats["misses"] += 1
+            return None
+
+        self.entries.move_to_end(url)
+        if age <= api["cache_ttl"]:
+            self.stats["hits"] += 1
+        else:
+            self.stats["stale_hits"] += 1
+            if url not in self.refreshing and url not in self.loading:
+                self.refreshing[url] = asyncio.create_task(self.refresh(api, url, country))
+        return entry[0]
+
+    def load(self, client, api, url, rates, country) -> asyncio.Task:
+        """Task fetching the vacancies of url, shared by everyone asking for it until it is done"""
+        task = self.loading.get(url)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            return task
+        task = self.loading[url] = asyncio.create_task(self.fetch(client, api, url, rates, country))
+        # the waiters may all time out, the exception is retrieved here so it is not reported as lost
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    async def fetch(self, client, api, url, rates, country):
+        try:
+            vacancies = await asyncio.wait_for(search_source(client, api, url, rates, country), api["timeout"])
+            self.put(url, vacancies)
+            return vacancies
+        finally:
+            del self.loading[url]
+
+    def put(self, url, vacancies):
+        old = self.entries.pop(url, None)
+        if old is not None:
+            self.vacancies -= len(old[0])
+        self.entries[url] = (vacancies, time.monotonic())
+        self.vacancies += len(vacancies)
+        while self.vacancies > self.max_vacancies and len(self.entries) > 1:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.vacancies -= len(evicted)
+            self.stats["evictions"] += 1
+
+    async def refresh(self, api, url, country):
+        try:
+            rates = exchange_rates.get()
+            if rates is None:
+                return
+            await self.load(http_client, api, url, rates, country)
+            self.stats["refreshes"] += 1
+        except Exception as exception:
+            print(f"Error refreshing {url}: {exception!r}")
+            self.stats["refresh_errors"] += 1
+        finally:
+            del self.refreshing[url]
+
+    def report(self):
+        return {**self.stats, "entries": len(self.entries), "vacancies": self.vacancies,
+                "loading": len(self.loading),
+                "refreshing": len(self.refreshing)}
+
+
+search_cache = SearchCache(SEARCH_CACHE_VACANCIES)
+
+
+class DescriptionCache:
+    """Text of job descriptions keyed by job URL and a hash of the HTML, so a vacancy seen again is not parsed
+    again, and an edited one is"""
+
+    def __init__(self, size):
+        self.size = size
+        self.texts = OrderedDict()  # {(job URL, HTML digest): text}
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def extract(self, api, jobs):
+        """Description text of every job, None for those which are not dicts"""
+        texts = [None] * len(jobs)
+        missing = {}  # {key: (HTML, [indexes of jobs])}
+        for index, job in enumerate(jobs):
+            if not isinstance(job, dict):
+                continue
+            description_html = job.get(api["description"]) or ""
+            digest = hashlib.blake2b(description_html.encode(), digest_size=16).digest()
+            key = (job.get(api["job_url"]), digest)
+            text = self.texts.get(key)
+            if text is not None:
+                self.texts.move_to_end(key)
+                self.stats["hits"] += 1
+                texts[index] = text
+            elif key in missing:
+                missing[key][1].append(index)
+            else:
+                self.stats["misses"] += 1
+                missing[key] = (description_html, [index])
+
+        if missing:
+            keys = list(missing)
+            extracted = await extract_descriptions([missing[key][0] for key in keys])
+            for key, text in zip(keys, extracted):
+                for index in missing[key][1]:
+                    texts[index] = text
+                self.texts[key] = text
+            while len(self.texts) > self.size:
+                self.texts.popitem(last=False)
+        return texts
+
+    def report(self):
+        return {**self.stats, "entries": len(self.texts)}
+
+
+async def extract_descriptions(descriptions_html):
+    if description_pool is None:
+        return helper.extract_descriptions(descriptions_html)
+    # one batch per worker, sending every description separately would cost more than parsing it
+    loop = asyncio.get_running_loop()
+    size = -(-len(descriptions_html) // DESCRIPTION_WORKERS)
+    batches = await asyncio.gather(*(loop.run_in_executor(description_pool, helper.extract_descriptions,
+                                                          descriptions_html[start:start + size])
+                                     for start in range(0, len(descriptions_html), size)))
+    return [text for batch in batches for text in batch]
+
+
+description_cache = DescriptionCache(DESCRIPTION_CACHE_SIZE)
+
+
+def task_error(task):
+    """Why a fetch gave no result, None if it did"""
+    # a search cancels the wrappers of fetches still running when its budget is spent
+    if not task.done() or task.cancelled():
+        return "timeout"
+    exception = task.exception()
+    if exception is None:
+        return None
+    if isinstance(exception, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exception, httpx.HTTPStatusError):
+        return f"HTTP {exception.response.status_code}"
+    if isinstance(exception, httpx.RequestError):
+        return "unavailable"
+    # bad JSON or vacancies missing fields parse_job_data expects, one provider must not fail the whole search
+    print(f"Invalid response: {exception!r}")
+    return "invalid response"
+
+
 @app.exception_handler(429)
 async def rate_limit_handler():
     return PlainTextResponse("Too many requests", status_code=429)
@@ -232,58 +539,66 @@ async def search_jobs(
         salaryMax: Optional[int] = None,
         industry: Optional[str] = None
 ):
-    async with httpx.AsyncClient(timeout=30) as client:
-        exchange_res = await client.get(EXCHANGE_API_URL)
-        if exchange_res.status_code != 200:
-            return JSONResponse(status_code=503, content={"error": "Currency conversion service unavailable"})
-        exchange_rates = exchange_res.json().get("rates", {})
-
-        vacancies = []
-
-        for api in JOBS_API:
-            job_level_param = jobLevel.value if (jobLevel != JobLevel.any and api["api_name"] != "jobdataapi") else ""
-            country = country.lower() if country else ""
-
-            formatted_url = api["url"].format(
-                title=jobTitle,
-                country=country,
-                jobLevel=job_level_param,
-                jobType=jobType.value,
-                salaryMin=salaryMin or 0,
-                salaryMax=salaryMax or 1000000,
-                industry=industry.lower() if industry else "",
-                location=country or ""
-            )
-
-            formatted_url = helper.clean_url_params(formatted_url)
-            print(f"Fetching jobs from: {formatted_url}")
-            try:
-                response = await client.get(formatted_url)
-                response.raise_for_status()
-                data = response.json()
-            except httpx.HTTPStatusError as e:
-                print(f"HTTP error from {api['api_name']}: {e}")
-                continue
-            except httpx.RequestError as e:
-                print(f"HTTP error from {api['api_name']}: {e}")
-                continue
-            except ValueError as e:
-                print(f"Invalid JSON response from {api['api_name']}: {e}")
-                continue
-
-            for job in data.get(api["results"], []):
-                vacancy = parse_job_data(api["api_name"], job, exchange_rates, country)
-                if vacancy:
-                    vacancies.append(vacancy)
-
-        filtered_vacancies = [
-            v for v in vacancies
-            if (jobLevel == JobLevel.any or jobLevel == v.job_level or v.job_level == JobLevel.any)
-               and (jobType == JobType.any or jobType in v.job_types)
-               and (v.salary_month is None or (
-                    (salaryMin is None or v.salary_month >= salaryMin) and
-                    (salaryMax is None or v.salary_month <= salaryMax)
-            ))
-        ]
-
-        return templates.TemplateResponse("response.html", {"request": request, "vacancies": filtered_vacancies})
+    country = country.lower() if country else ""
+    rates = exchange_rates.get()
+    if rates is None:
+        return JSONResponse(status_code=503, content={"error": "Currency conversion service unavailable"})
+
+    vacancies = []
+    tasks = []
+    for api in JOBS_API:
+        job_level_param = jobLevel.value if (jobLevel != JobLevel.any and api["api_name"] != "jobdataapi") else ""
+
+        formatted_url = api["url"].format(
+            title=jobTitle,
+            country=country,
+            jobLevel=job_level_param,
+            jobType=jobType.value,
+            salaryMin=salaryMin or 0,
+            salaryMax=salaryMax or 1000000,
+            industry=industry.lower() if industry else "",
+            location=country or ""
+        )
+
+        formatted_url = helper.clean_url_params(formatted_url)
+        cached = search_cache.get(api, formatted_url, country)
+        if cached is not None:
+            vacancies += cached
+            continue
+        # shielded, a search running out of its budget must not cancel the fetch other searches wait for
+        tasks.append((api, asyncio.shield(search_cache.load(http_client, api, formatted_url, rates, country))))
+
+    if tasks:
+        await asyncio.wait([task for _, task in tasks], timeout=SEARCH_TIMEOUT)
+    for _, task in tasks:
+        task.cancel()
+
+    failed_sources = []
+    for api, task in tasks:
+        error = task_error(task)
+        if error:
+            print(f"No results from {api['api_name']}: {error}")
+            failed_sources.append({"source": api["api_name"], "error": error})
+        else:
+            vacancies += task.result()
+
+    filtered_vacancies = [
+        v for v in vacancies
+        if (jobLevel == JobLevel.any or jobLevel == v.job_level or v.job_level == JobLevel.any)
+           and (jobType == JobType.any or jobType in v.job_types)
+           and (v.salary_month is None or (
+                (salaryMin is None or v.salary_month >= salaryMin) and
+                (salaryMax is None or v.salary_month <= salaryMax)
+        ))
+    ]
+
+    response = templates.TemplateResponse("response.html", {"request": request, "vacancies": filtered_vacancies,
+                                                             "failed_sources": failed_sources})
+    if failed_sources:
+        response.headers["X-Failed-Sources"] = ", ".join(source["source"] for source in failed_sources)
+    return response
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**search_cache.report(), "descriptions": description_cache.report()}
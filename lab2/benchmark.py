@@ -0,0 +1,248 @@
+"""In-process load benchmark for the doodle API.
+
+Drives the FastAPI app through httpx.ASGITransport, so no network is involved. Creates polls, preloads
+votes through the bulk endpoint and then runs a mix of poll creation, voting, vote updates and removals,
+result reads and paginated listings from concurrent clients. Throughput, latency percentiles per operation
+and memory of the process are printed and one JSON line is appended to --output.
+
+    python benchmark.py --polls 1000 --preload-votes 1000000 --operations 50000
+    python benchmark.py --storage sqlite --database /tmp/doodle.db --concurrency 128
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+OPERATIONS = ("create", "vote", "revote", "unvote", "results", "poll", "list")
+DEFAULT_MIX = "create=1,vote=50,revote=10,unvote=4,results=25,poll=5,list=5"
+OPTIONS = ["Option A", "Option B", "Option C", "Option D"]
+PRELOAD_BATCH = 50000
+
+
+class Workload:
+    """Polls and votes the clients know about, so updates and removals hit existing votes"""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.poll_ids = []
+        self.votes = []  # (poll_id, user_id) of votes which can be updated or removed
+        self.next_user = 0
+        self.etags = {}  # {poll_id: ETag of the last results read}
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.statuses = {}
+
+    def hot_poll(self) -> str:
+        # skewed towards the first polls, a few of them get most of the traffic
+        return self.poll_ids[int(len(self.poll_ids) * self.random.random() ** self.args.skew)]
+
+    def new_user(self) -> str:
+        self.next_user += 1
+        return f"user-{self.next_user}"
+
+    def take_vote(self):
+        # swap with the last one, so removing is O(1)
+        index = self.random.randrange(len(self.votes))
+        self.votes[index], self.votes[-1] = self.votes[-1], self.votes[index]
+        return self.votes.pop()
+
+    def record(self, operation, status, seconds):
+        self.latencies[operation].append(seconds)
+        self.statuses[f"{operation} {status}"] = self.statuses.get(f"{operation} {status}", 0) + 1
+
+
+def create_body(index):
+    return {"question": f"Benchmark question number {index} about topic {index % 100}",
+            "description": "Generated by benchmark.py", "options": OPTIONS}
+
+
+async def setup(client, workload, args):
+    for index in range(args.polls):
+        response = await client.post("/polls/", json=create_body(index))
+        workload.poll_ids.append(response.json()["id"])
+
+    loaded = 0
+    while loaded < args.preload_votes:
+        lines = []
+        for _ in range(min(PRELOAD_BATCH, args.preload_votes - loaded)):
+            poll_id, user_id = workload.hot_poll(), workload.new_user()
+            workload.votes.append((poll_id, user_id))
+            lines.append(json.dumps({"poll_id": poll_id, "user_id": user_id,
+                                     "option": workload.random.choice(OPTIONS)}))
+        await client.post("/votes/bulk/", content="\n".join(lines))
+        loaded += len(lines)
+
+
+async def run_operation(client, workload, operation):
+    args = workload.args
+    vote = None
+    if operation in ("revote", "unvote") and not workload.votes:
+        operation = "vote"
+
+    started = time.perf_counter()
+    if operation == "create":
+        response = await client.post("/polls/", json=create_body(len(workload.poll_ids)))
+    elif operation == "vote":
+        vote = workload.hot_poll(), workload.new_user()
+        response = await client.post(f"/polls/{vote[0]}/vote/",
+                                     json={"user_id": vote[1], "option": workload.random.choice(OPTIONS)})
+    elif operation == "revote":
+        vote = workload.take_vote()
+        response = await client.put(f"/polls/{vote[0]}/vote/",
+                                    json={"user_id": vote[1], "option": workload.random.choice(OPTIONS)})
+    elif operation == "unvote":
+        poll_id, user_id = workload.take_vote()
+        response = await client.request("DELETE", f"/polls/{poll_id}/vote/",
+                                        json={"user_id": user_id, "option": OPTIONS[0]})
+    elif operation == "results":
+        poll_id = workload.hot_poll()
+        etag = workload.etags.get(poll_id)
+        headers = {"If-None-Match": etag} if etag and workload.random.random() < args.conditional else {}
+        response = await client.get(f"/polls/{poll_id}/results/", headers=headers)
+        workload.etags[poll_id] = response.headers.get("etag")
+    elif operation == "poll":
+        response = await client.get(f"/polls/{workload.hot_poll()}")
+    else:
+        # a page somewhere in the listing, found by the id before it
+        after = int(workload.random.choice(workload.poll_ids)) - 1
+        response = await client.get("/polls/", params={"after": after, "limit": args.page_size})
+    workload.record(operation, response.status_code, time.perf_counter() - started)
+
+    if operation == "create" and response.status_code == 201:
+        workload.poll_ids.append(response.json()["id"])
+    elif operation in ("vote", "revote") and response.status_code == 200:
+        workload.votes.append(vote)
+
+
+async def client_loop(client, workload, operations, weights, deadline, count):
+    while count[0] > 0 and time.perf_counter() < deadline:
+        count[0] -= 1
+        operation = workload.random.choices(operations, weights)[0]
+        await run_operation(client, workload, operation)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {operation}, known: {', '.join(OPERATIONS)}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+
+    return {"count": len(values), "p50": at(0.5), "p99": at(0.99), "p999": at(0.999),
+            "max": round(values[-1] * 1000, 3)}
+
+
+def memory_kb():
+    """Current and peak resident memory of this process, None where /proc is not available"""
+    try:
+        usage = {}
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    usage["rss_kb" if line.startswith("VmRSS") else "peak_rss_kb"] = int(line.split()[1])
+        return usage
+    except OSError:
+        return None
+
+
+def load_app(args):
+    # storage is chosen when doodle is imported
+    os.environ.pop("DOODLE_DATABASE", None)
+    os.environ.pop("DOODLE_DATA_DIR", None)
+    if args.storage == "sqlite":
+        os.environ["DOODLE_DATABASE"] = args.database
+    elif args.data_dir:
+        os.environ["DOODLE_DATA_DIR"] = args.data_dir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    return importlib.import_module("doodle")
+
+
+async def run(args, doodle, workload):
+    weights = parse_mix(args.mix)
+    transport = httpx.ASGITransport(app=doodle.app)
+    async with doodle.lifespan(doodle.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://doodle", timeout=None) as client:
+            started = time.perf_counter()
+            await setup(client, workload, args)
+            setup_seconds = time.perf_counter() - started
+            print(f"Created {args.polls} polls and {args.preload_votes} votes in {setup_seconds:.1f} s")
+
+            count = [args.operations]
+            started = time.perf_counter()
+            deadline = started + args.duration if args.duration else float("inf")
+            await asyncio.gather(*(client_loop(client, workload, list(weights), list(weights.values()),
+                                               deadline, count) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+    return setup_seconds, elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="In-process load benchmark for the doodle API")
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--database", default="benchmark_doodle.db", help="SQLite file for --storage sqlite")
+    parser.add_argument("--data-dir", help="write-ahead log directory for the memory storage")
+    parser.add_argument("--polls", type=int, default=1000, help="polls created before the measurement")
+    parser.add_argument("--preload-votes", type=int, default=100000, help="votes added in bulk before it")
+    parser.add_argument("--operations", type=int, default=20000, help="requests of the measured phase")
+    parser.add_argument("--duration", type=float, default=0, help="stop the measured phase after this many seconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="clients sending requests at the same time")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weights of the operations")
+    parser.add_argument("--skew", type=float, default=3, help="higher values send more traffic to fewer polls")
+    parser.add_argument("--conditional", type=float, default=0.5,
+                        help="fraction of result reads sending the ETag of the previous read")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="file the JSON result line is added to")
+    args = parser.parse_args()
+    args.polls = max(1, args.polls)
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.storage == "sqlite" and os.path.exists(args.database):
+        raise SystemExit(f"{args.database} exists, the benchmark needs an empty database")
+    doodle = load_app(args)
+    workload = Workload(args)
+
+    before = memory_kb()
+    setup_seconds, elapsed = asyncio.run(run(args, doodle, workload))
+    after = memory_kb()
+
+    requests = sum(len(latencies) for latencies in workload.latencies.values())
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "setup_seconds": round(setup_seconds, 3),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1),
+        "latency_ms": {operation: percentiles(latencies) for operation, latencies in workload.latencies.items()
+                       if latencies},
+        "statuses": dict(sorted(workload.statuses.items())),
+        "memory": {"before": before, "after": after},
+    }
+
+    print(json.dumps(result, indent=2))
+    with open(args.output, "a") as output:
+        output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,58 @@
-from fastapi import Body, FastAPI, status
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from fastapi import Body, FastAPI, Request, status
 from typing import Union
 from pydantic import BaseModel
-from typing import List, Dict
-from fastapi.responses import JSONResponse
+from typing import List
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
-app = FastAPI()
+from live import LiveResults
+from persistence import Journal
+from storage import VOTE_ACTIONS, MemoryStorage, PollNotFound, SqliteStorage, StorageBusy, VoteError
+
+# SQLite database shared by all workers, e.g. `DOODLE_DATABASE=doodle.db uvicorn doodle:app --workers 4`
+DATABASE = os.environ.get("DOODLE_DATABASE")
+# directory of the write-ahead log and snapshots of a single worker, without either polls are kept only in memory
+DATA_DIR = os.environ.get("DOODLE_DATA_DIR")
+
+storage = SqliteStorage(DATABASE) if DATABASE else MemoryStorage()
+journal = Journal(storage, DATA_DIR) if DATA_DIR and not DATABASE else None
+# other workers change the database too, so with it every watched poll is checked for changes
+live = LiveResults(storage.results, watch_all=bool(DATABASE))
+
+BULK_BATCH = 5000
+
+RESPONSE_CACHE_SIZE = 10000
+WRITE_TIMEOUT = 10  # seconds a mutation waits for the write lock of the SQLite database before 503
+# versions of the in-memory storage start from zero again after a restart, so its ETags include the start time
+ETAG_PREFIX = "" if DATABASE else f"{time.time_ns():x}-"
+response_cache: OrderedDict = OrderedDict()  # {(endpoint, poll_id): (etag, body)}, least recently used first
+JOURNAL_RECORDS = {"add": "vote", "update": "revote", "delete": "unvote"}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if journal:
+        journal.open()
+    yield
+    if journal:
+        await journal.close()
+    if DATABASE:
+        storage.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.exception_handler(StorageBusy)
+async def storage_busy(request: Request, error: StorageBusy):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"message": "Database is busy"},
+                        headers={"Retry-After": "1"})
 
 
 class Poll(BaseModel):
@@ -18,51 +66,115 @@ class Vote(BaseModel):
     option: str
 
 
-polls_db: Dict[str, Poll] = {}
-votes_db: Dict[str, Dict[str, str]] = {}  # {poll_id: {user_id: selected_option}}
+async def write(operation, *args):
+    """Calls a mutation of storage, retrying it while another worker holds the write lock of the database.
+    The waits are async, so the other requests of this worker go on meanwhile."""
+    deadline = time.monotonic() + WRITE_TIMEOUT
+    delay = 0.001
+    while True:
+        try:
+            return operation(*args)
+        except StorageBusy:
+            if time.monotonic() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+
+async def log(*record):
+    """Called after every mutation applied to storage, returns once it is durable"""
+    live.changed(record[1])
+    if journal:
+        await journal.append(*record)
+
+
+def poll_not_found():
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
+
+
+def vote_error(error: VoteError):
+    return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": str(error)})
+
+
+def etag_matches(if_none_match: Union[str, None], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def cached_response(request: Request, endpoint: str, poll_id: str, build, version) -> Response:
+    """Body of a read endpoint, serialized again only after version(poll_id) changed, or 304 if the client has
+    it already"""
+    version = version(poll_id)
+    if version is None:
+        return poll_not_found()
+
+    # the endpoint is part of the tag, the tag of one representation never validates another
+    etag = f'"{ETAG_PREFIX}{endpoint}-{poll_id}.{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-last_poll_id = 0
+    key = (endpoint, poll_id)
+    cached = response_cache.get(key)
+    if cached is not None and cached[0] == etag:
+        body = cached[1]
+    else:
+        try:
+            body = json.dumps(build(poll_id), ensure_ascii=False, separators=(",", ":")).encode()
+        except PollNotFound:
+            # deleted by another worker in the meantime
+            return poll_not_found()
+        response_cache[key] = (etag, body)
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+    response_cache.move_to_end(key)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def poll_body(poll_id: str) -> dict:
+    poll = storage.get_poll(poll_id)
+    if poll is None:
+        raise PollNotFound(poll_id)
+    return {"poll_id": poll_id, **poll}
+
+
+def results_body(poll_id: str) -> dict:
+    return {"poll_id": poll_id, "results": storage.results(poll_id)}
 
 
 @app.get("/polls/")
-async def get_polls(skip: int = 0, limit: int = 10):
-    if not polls_db:
+async def get_polls(skip: int = 0, limit: int = 10, after: Union[int, None] = None, q: Union[str, None] = None):
+    """Pages by id: pass the id of the last poll of a page as `after` to get the next one, which costs the same
+    however deep it is. `q` keeps only polls whose question contains all its words."""
+    if not storage:
         return {"message": "No polls found"}
 
-    poll_ids = list(polls_db.keys())
-    selected_polls = poll_ids[skip: skip + limit]
-
-    return [{"id": poll_id, "question": polls_db[poll_id].question, "description": polls_db[poll_id].description,
-             "options": polls_db[poll_id].options}
-            for poll_id in selected_polls]
+    return [{"id": poll_id, "question": poll["question"], "description": poll["description"],
+             "options": poll["options"]}
+            for poll_id, poll in storage.list_polls(skip, limit, after, q)]
 
 
 @app.get("/polls/{poll_id}")
-async def get_poll(poll_id: str):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    poll = polls_db[poll_id]
-    return {"poll_id": poll_id, **poll.dict()}
+async def get_poll(poll_id: str, request: Request):
+    return cached_response(request, "poll", poll_id, poll_body, storage.definition_version)
 
 
 @app.delete("/polls/{poll_id}")
 async def delete_poll(poll_id: str):
-    if poll_id in polls_db:
-        del polls_db[poll_id]
-        votes_db.pop(poll_id, None)
-        return JSONResponse(status_code=status.HTTP_204_NO_CONTENT)
-    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
+    if await write(storage.delete_poll, poll_id):
+        response_cache.pop(("poll", poll_id), None)
+        response_cache.pop(("results", poll_id), None)
+        await log("delete", poll_id)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    return poll_not_found()
 
 
 @app.post("/polls/")
 async def create_poll(poll: Poll):
-    global last_poll_id
-
-    last_poll_id += 1
-    poll_id = str(last_poll_id)
-
-    polls_db[poll_id] = poll
+    poll_id = await write(storage.create_poll, poll.dict())
+    await log("create", poll_id, poll.dict())
 
     return JSONResponse(status_code=status.HTTP_201_CREATED, content={"id": poll_id, **poll.dict()})
 
@@ -71,87 +183,184 @@ async def create_poll(poll: Poll):
 async def update_poll(poll_id: str, question: Union[str, None] = Body(default=None),
                       description: Union[str, None] = Body(default=None),
                       options: Union[List[str], None] = Body(default=None)):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    if sum(votes_db.get(poll_id, {}).values()) > 0:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
-                            content={"message": "There are votes for this poll"})
-
-    # update only if there are no votes
-    poll = polls_db[poll_id]
-    updated_poll = poll.copy(update={
-        "question": question if question is not None else poll.question,
-        "description": description if description is not None else poll.description,
-        "options": options if options is not None else poll.options,
-    })
-    polls_db[poll_id] = updated_poll
-
+    changes = {"question": question, "description": description, "options": options}
+    try:
+        updated_poll = await write(storage.update_poll, poll_id, changes)
+    except PollNotFound:
+        return poll_not_found()
+    except VoteError as error:
+        return vote_error(error)
+
+    await log("update", poll_id, changes)
     return updated_poll
 
 
 @app.post("/polls/{poll_id}/vote/")
 async def add_vote(poll_id: str, vote: Vote):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    if vote.option not in polls_db[poll_id].options:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Invalid option"})
+    try:
+        await write(storage.add_vote, poll_id, vote.user_id, vote.option)
+    except PollNotFound:
+        return poll_not_found()
+    except VoteError as error:
+        return vote_error(error)
 
-    if poll_id not in votes_db:
-        votes_db[poll_id] = {}
-
-    if vote.user_id in votes_db[poll_id]:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "User has already voted"})
-
-    votes_db[poll_id][vote.user_id] = vote.option
+    await log("vote", poll_id, vote.user_id, vote.option)
 
     return {"message": "Vote successfully added", "poll_id": poll_id, "option": vote.option}
 
 
 @app.put("/polls/{poll_id}/vote/")
 async def update_vote(poll_id: str, vote: Vote):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    if vote.option not in polls_db[poll_id].options:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Invalid option"})
+    try:
+        await write(storage.update_vote, poll_id, vote.user_id, vote.option)
+    except PollNotFound:
+        return poll_not_found()
+    except VoteError as error:
+        return vote_error(error)
 
-    if poll_id not in votes_db or vote.user_id not in votes_db[poll_id]:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "User has not voted yet"})
-
-    votes_db[poll_id][vote.user_id] = vote.option
+    await log("revote", poll_id, vote.user_id, vote.option)
 
     return {"message": "Vote updated", "poll_id": poll_id, "option": vote.option}
 
 
 @app.delete("/polls/{poll_id}/vote/")
 async def delete_vote(poll_id: str, vote: Vote):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    if vote.option not in polls_db[poll_id].options:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Invalid option"})
+    try:
+        await write(storage.delete_vote, poll_id, vote.user_id, vote.option)
+    except PollNotFound:
+        return poll_not_found()
+    except VoteError as error:
+        return vote_error(error)
 
-    if poll_id not in votes_db or vote.user_id not in votes_db[poll_id]:
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "No vote found for this user"})
-
-    del votes_db[poll_id][vote.user_id]
+    await log("unvote", poll_id, vote.user_id, vote.option)
 
     return {"message": "Vote removed", "poll_id": poll_id}
 
 
 @app.get("/polls/{poll_id}/results/")
-async def get_poll_results(poll_id: str):
-    if poll_id not in polls_db:
-        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Poll not found"})
-
-    vote_counts = {option: 0 for option in polls_db[poll_id].options}
-
-    if poll_id not in votes_db or not votes_db[poll_id]:
-        return {"poll_id": poll_id, "results": vote_counts}
-
-    for user_id, selected_option in votes_db[poll_id].items():
-        vote_counts[selected_option] += 1
-
-    return {"poll_id": poll_id, "results": vote_counts}
+async def get_poll_results(poll_id: str, request: Request):
+    return cached_response(request, "results", poll_id, results_body, storage.version)
+
+
+@app.get("/polls/{poll_id}/results/stream/")
+async def stream_poll_results(poll_id: str):
+    """Server-Sent Events: "results" with all counts first, then "delta" with the changed counts at most
+    4 times per second, "deleted" when the poll is removed"""
+    try:
+        subscriber = live.subscribe(poll_id)
+    except PollNotFound:
+        return poll_not_found()
+
+    async def events():
+        try:
+            while True:
+                event = await subscriber.next()
+                if event is None:
+                    yield b": keep-alive\n\n"
+                    continue
+                yield event
+                if event.startswith(b"event: deleted"):
+                    return
+        finally:
+            live.unsubscribe(poll_id, subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def parse_bulk_vote(item) -> Union[tuple, None]:
+    """(action, poll_id, user_id, option) of one vote of a bulk request, None if it is malformed"""
+    if not isinstance(item, dict):
+        return None
+    poll_id = item.get("poll_id")
+    vote = (item.get("action", "add"), str(poll_id) if isinstance(poll_id, int) else poll_id,
+            item.get("user_id"), item.get("option"))
+    if vote[0] not in VOTE_ACTIONS or not all(isinstance(value, str) for value in vote[1:]):
+        return None
+    return vote
+
+
+def parse_bulk_line(line: bytes) -> Union[tuple, None]:
+    try:
+        return parse_bulk_vote(json.loads(line))
+    except ValueError:
+        return None
+
+
+async def read_bulk_votes(request: Request):
+    """Votes of an NDJSON body, parsed as it arrives, or of a JSON array body"""
+    pending = b""
+    chunks = None  # whole body, only for a JSON array
+    async for chunk in request.stream():
+        if chunks is not None:
+            chunks.append(chunk)
+            continue
+        if not pending.strip() and chunk.lstrip().startswith(b"["):
+            chunks = [pending, chunk]
+            continue
+
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_bulk_line(line)
+
+    if chunks is not None:
+        try:
+            items = json.loads(b"".join(chunks))
+        except ValueError:
+            items = [None]
+        for item in items if isinstance(items, list) else [None]:
+            yield parse_bulk_vote(item)
+    elif pending.strip():
+        yield parse_bulk_line(pending)
+
+
+async def apply_bulk_votes(batch: list, index: int) -> bytes:
+    """Applies votes of one batch, the first of them is the index-th vote of the request, returns result lines"""
+    try:
+        errors = iter(await write(storage.apply_votes, [vote for vote in batch if vote]))
+    except StorageBusy:
+        # nothing of the batch was applied, the votes applied in earlier batches stay
+        return b"".join(b'{"index":%d,"status":503,"message":"Database is busy"}\n' % index
+                        for index in range(index, index + len(batch)))
+    results = []
+    durable = []
+    for index, vote in enumerate(batch, index):
+        if vote is None:
+            results.append(b'{"index":%d,"status":400,"message":"Invalid vote"}\n' % index)
+            continue
+
+        error = next(errors)
+        if error is None:
+            results.append(b'{"index":%d,"status":200}\n' % index)
+            live.changed(vote[1])
+            if journal:
+                durable.append(journal.append(JOURNAL_RECORDS[vote[0]], *vote[1:]))
+        elif isinstance(error, PollNotFound):
+            results.append(b'{"index":%d,"status":404,"message":"Poll not found"}\n' % index)
+        else:
+            results.append(json.dumps({"index": index, "status": 400, "message": str(error)},
+                                      separators=(",", ":")).encode() + b"\n")
+
+    # one group commit for the whole batch
+    await asyncio.gather(*durable)
+    return b"".join(results)
+
+
+@app.post("/votes/bulk/")
+async def add_votes_bulk(request: Request):
+    """Body is NDJSON with one {"poll_id", "user_id", "option", "action"} per line, action is add (default), update
+    or delete, a JSON array of them works too. Answers one NDJSON line {"index", "status", "message"} per vote."""
+    results = []
+    batch = []
+    count = 0
+    async for vote in read_bulk_votes(request):
+        batch.append(vote)
+        if len(batch) == BULK_BATCH:
+            results.append(await apply_bulk_votes(batch, count))
+            count += len(batch)
+            batch = []
+    if batch:
+        results.append(await apply_bulk_votes(batch, count))
+
+    # the body has to be read completely first, Starlette takes over receiving once the response starts
+    return StreamingResponse(iter(results), media_type="application/x-ndjson")
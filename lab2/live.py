@@ -0,0 +1,128 @@
+import asyncio
+import json
+from typing import Callable, Dict, Optional
+
+from storage import PollNotFound
+
+UPDATE_INTERVAL = 0.25  # at most 4 updates per second to every subscriber, however fast votes come in
+HEARTBEAT = 15  # seconds, keeps proxies from closing an idle stream
+
+
+def encode_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+class Subscriber:
+    """One open stream. Updates it has not sent yet are merged, so a slow client gets fewer, bigger updates."""
+
+    __slots__ = ("ready", "event", "data", "encoded")
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.event = None
+        self.data = None
+        self.encoded = None
+
+    def push(self, event: str, data: dict, encoded: bytes):
+        if self.event is None or event != "delta":
+            # nothing pending, or the new event replaces it
+            self.event, self.data, self.encoded = event, data, encoded
+        else:
+            # delta on top of pending results or delta
+            self.data = {**self.data, "results": {**self.data["results"], **data["results"]}}
+            self.encoded = None
+        self.ready.set()
+
+    async def next(self) -> Optional[bytes]:
+        """Next event, None when no update came within HEARTBEAT"""
+        try:
+            await asyncio.wait_for(self.ready.wait(), HEARTBEAT)
+        except asyncio.TimeoutError:
+            return None
+        self.ready.clear()
+        encoded = self.encoded or encode_event(self.event, self.data)
+        self.event = self.data = self.encoded = None
+        return encoded
+
+
+class LiveResults:
+    """Pushes results of polls to their subscribers once per window, only when they changed.
+
+    changed() is called after every mutation and only marks the poll. With watch_all every subscribed poll is
+    checked each window instead, for storages changed by other processes too.
+    """
+
+    def __init__(self, results: Callable[[str], Dict[str, int]], watch_all=False, interval=UPDATE_INTERVAL):
+        self.results = results
+        self.watch_all = watch_all
+        self.interval = interval
+        self.subscribers: Dict[str, set] = {}  # {poll_id: {Subscriber}}
+        self.last_results: Dict[str, dict] = {}  # what the subscribers of a poll got so far
+        self.changed_polls = set()
+        self.task = None
+
+    def changed(self, poll_id: str):
+        if poll_id in self.subscribers:
+            self.changed_polls.add(poll_id)
+
+    def subscribe(self, poll_id: str) -> Subscriber:
+        """Raises PollNotFound, the subscriber starts with the current results"""
+        results = self.results(poll_id)
+        subscriber = Subscriber()
+        subscriber.push("results", {"poll_id": poll_id, "results": results}, None)
+
+        if poll_id not in self.subscribers:
+            self.subscribers[poll_id] = set()
+            self.last_results[poll_id] = results
+        elif results != self.last_results[poll_id]:
+            # the others get the difference in the next window
+            self.changed_polls.add(poll_id)
+        self.subscribers[poll_id].add(subscriber)
+
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return subscriber
+
+    def unsubscribe(self, poll_id: str, subscriber: Subscriber):
+        subscribers = self.subscribers.get(poll_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self.subscribers[poll_id]
+            del self.last_results[poll_id]
+            self.changed_polls.discard(poll_id)
+
+    async def run(self):
+        try:
+            while self.subscribers:
+                await asyncio.sleep(self.interval)
+                changed = set(self.subscribers) if self.watch_all else self.changed_polls
+                self.changed_polls = set()
+                for poll_id in changed:
+                    if poll_id in self.subscribers:
+                        self.publish(poll_id)
+        finally:
+            self.task = None
+
+    def publish(self, poll_id: str):
+        try:
+            results = self.results(poll_id)
+        except PollNotFound:
+            event, data = "deleted", {"poll_id": poll_id}
+        else:
+            last = self.last_results[poll_id]
+            if results == last:
+                return
+            self.last_results[poll_id] = results
+            if results.keys() == last.keys():
+                event, data = "delta", {"poll_id": poll_id, "results": {option: count for option, count
+                                                                        in results.items() if last[option] != count}}
+            else:
+                # options of the poll were changed
+                event, data = "results", {"poll_id": poll_id, "results": results}
+
+        # encoded once for all subscribers
+        encoded = encode_event(event, data)
+        for subscriber in self.subscribers[poll_id]:
+            subscriber.push(event, data, encoded)
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import pickle
+import time
+from collections import deque
+from typing import List
+
+from storage import MemoryStorage, PollNotFound, VoteError
+
+# Mutations are appended to the current segment of the write-ahead log, wal-<segment>.log, one JSON line each.
+# A snapshot covers every segment before the one it names, so those are deleted once it is written.
+SNAPSHOT_FILE = "snapshot.pickle"
+SNAPSHOT_INTERVAL = 60  # seconds
+SNAPSHOT_RECORDS = 100000  # snapshot earlier when this many mutations were logged since the last one
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"wal-{segment:08d}.log")
+
+
+def list_segments(directory: str) -> List[int]:
+    return sorted(int(name[4:-4]) for name in os.listdir(directory)
+                  if name.startswith("wal-") and name.endswith(".log"))
+
+
+def write_lines(file, lines):
+    file.write(b"".join(lines))
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def write_snapshot(directory: str, state: dict):
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def apply_record(storage: MemoryStorage, record: list):
+    kind, poll_id, *args = record
+    if kind == "create":
+        storage.create_poll(args[0], poll_id)
+    elif kind == "update":
+        storage.update_poll(poll_id, args[0])
+    elif kind == "delete":
+        storage.delete_poll(poll_id)
+    elif kind == "vote":
+        storage.add_vote(poll_id, *args)
+    elif kind == "revote":
+        storage.update_vote(poll_id, *args)
+    elif kind == "unvote":
+        storage.delete_vote(poll_id, *args)
+
+
+class Journal:
+    """Write-ahead log with group commit and periodic snapshots of a MemoryStorage.
+
+    append() is called right after the mutation was applied in memory and the request is answered once the
+    returned future is done. Lines appended while a batch is being fsync-ed are written together in the next one,
+    so any number of waiting requests costs one fsync.
+    """
+
+    def __init__(self, storage: MemoryStorage, directory: str):
+        self.storage = storage
+        self.directory = directory
+        self.segment = 0
+        self.file = None
+        self.lines = []
+        self.waiters = []
+        self.batches = deque()  # (file, lines, waiters) sealed and waiting to be written
+        self.flushing = None
+        self.writing_file = None  # file of the batch being written, rotate() must not close it
+        self.records = 0  # since the last snapshot
+        self.last_snapshot = time.monotonic()
+        self.stopped = asyncio.Event()
+        self.snapshots = None
+
+    def open(self):
+        """Load the snapshot and replay the log written after it"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        first_segment = 0
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                state = pickle.load(file)
+            self.storage.load(state)
+            first_segment = state["segment"]
+
+        segments = [segment for segment in list_segments(self.directory) if segment >= first_segment]
+        for segment in segments:
+            self.records += self.replay(segment_path(self.directory, segment))
+
+        # the last segment may end with a torn line, so new records always go to a fresh one
+        self.segment = max(segments + [first_segment - 1]) + 1
+        self.file = open(segment_path(self.directory, self.segment), "ab")
+        self.snapshots = asyncio.create_task(self.run_snapshots())
+        print(f"Loaded {len(self.storage)} polls, replayed {self.records} log records")
+
+    def replay(self, path: str) -> int:
+        count = 0
+        with open(path, "rb") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # unfinished write of a crashed server, nothing after it was acknowledged
+                    break
+                try:
+                    apply_record(self.storage, record)
+                except (PollNotFound, VoteError):
+                    pass
+                count += 1
+        return count
+
+    def append(self, *record) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.lines.append(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        self.waiters.append(future)
+        self.records += 1
+        if self.flushing is None:
+            self.flushing = asyncio.create_task(self.flush())
+        return future
+
+    def seal(self):
+        if self.lines:
+            self.batches.append((self.file, self.lines, self.waiters))
+            self.lines, self.waiters = [], []
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.lines or self.batches:
+                self.seal()
+                file, lines, waiters = self.batches.popleft()
+                self.writing_file = file
+                try:
+                    await loop.run_in_executor(None, write_lines, file, lines)
+                except Exception as exception:
+                    # a waiter which is never resolved would hang its request forever
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(exception)
+                else:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+                finally:
+                    self.writing_file = None
+
+                if file is not self.file and all(batch[0] is not file for batch in self.batches):
+                    file.close()
+        finally:
+            self.flushing = None
+
+    def rotate(self) -> int:
+        """Start a new segment, lines appended until now still go to the old one"""
+        self.seal()
+        old_file = self.file
+        self.segment += 1
+        self.file = open(segment_path(self.directory, self.segment), "ab")
+        # otherwise flush() closes it after writing the last batch
+        if old_file is not self.writing_file and all(batch[0] is not old_file for batch in self.batches):
+            old_file.close()
+        return self.segment
+
+    async def snapshot(self):
+        # the copy and the rotation happen without awaiting in between, so the snapshot matches the log exactly
+        state = self.storage.dump()
+        state["segment"] = self.rotate()
+        self.records = 0
+        self.last_snapshot = time.monotonic()
+
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot, self.directory, state)
+        for segment in list_segments(self.directory):
+            if segment < state["segment"]:
+                os.remove(segment_path(self.directory, segment))
+
+    async def run_snapshots(self):
+        while not self.stopped.is_set():
+            try:
+                await asyncio.wait_for(self.stopped.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            if self.records >= SNAPSHOT_RECORDS or \
+                    (self.records and time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL):
+                try:
+                    await self.snapshot()
+                except OSError as exception:
+                    print(f"Error writing snapshot: {exception}")
+
+    async def close(self):
+        self.stopped.set()
+        await self.snapshots
+        if self.records:
+            await self.snapshot()
+        if self.flushing is not None:
+            await self.flushing
+        self.file.close()
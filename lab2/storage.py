@@ -0,0 +1,637 @@
+import json
+import re
+import sqlite3
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from typing import Dict, List, Optional, Set
+
+VOTE_ACTIONS = ("add", "update", "delete")
+
+WORD = re.compile(r"\w+")
+
+
+class PollNotFound(Exception):
+    pass
+
+
+class VoteError(Exception):
+    pass
+
+
+class StorageBusy(Exception):
+    """Another process holds the write lock of the database, the operation can be tried again"""
+
+
+def question_words(text: str) -> Set[str]:
+    """Words a poll can be found by, a search matches polls whose question has all words of the query"""
+    return set(WORD.findall(text.lower()))
+
+
+class UserTable:
+    """Every user id stored once for all polls, which only keep its index. The UTF-8 ids are concatenated in one
+    bytearray, ends[index] is where the id of index ends, and slots is an open addressing hash table of index + 1
+    (0 is a free slot), at most 2/3 full. No Python object is kept per user, a user costs the bytes of its id and
+    about 12 more."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array("I")
+        self.slots = array("I", bytes(4 * 1024))
+        self.mask = 1023
+
+    def __len__(self):
+        return len(self.ends)
+
+    def key(self, index: int) -> bytes:
+        return self.data[self.ends[index - 1] if index else 0:self.ends[index]]
+
+    def user_id(self, index: int) -> str:
+        return self.key(index).decode()
+
+    def find(self, key: bytes) -> tuple:
+        """(index of the user or None, slot where it is or would be)"""
+        slot = hash(key) & self.mask
+        while True:
+            stored = self.slots[slot]
+            if not stored:
+                return None, slot
+            if self.key(stored - 1) == key:
+                return stored - 1, slot
+            slot = (slot + 1) & self.mask
+
+    def get(self, user_id: str) -> Optional[int]:
+        return self.find(user_id.encode())[0]
+
+    def intern(self, user_id: str) -> int:
+        key = user_id.encode()
+        index, slot = self.find(key)
+        if index is None:
+            index = len(self.ends)
+            self.data += key
+            if len(self.data) > 0xFFFFFFFF and self.ends.typecode == "I":
+                self.ends = array("Q", self.ends)
+            self.ends.append(len(self.data))
+            self.slots[slot] = index + 1
+            if 3 * len(self.ends) > 2 * len(self.slots):
+                self.rehash(2 * len(self.slots))
+        return index
+
+    def rehash(self, size: int):
+        self.slots = array("I", bytes(4 * size))
+        self.mask = size - 1
+        for index in range(len(self.ends)):
+            self.slots[self.find(bytes(self.key(index)))[1]] = index + 1
+
+    def dump(self) -> tuple:
+        return bytes(self.data), self.ends[:]
+
+    def load(self, state):
+        """state of dump(), or a list of user ids from older snapshots"""
+        if isinstance(state, tuple):
+            self.data, self.ends = bytearray(state[0]), state[1][:]
+        else:
+            self.data = bytearray(b"".join(user_id.encode() for user_id in state))
+            self.ends = array("I" if len(self.data) <= 0xFFFFFFFF else "Q")
+            end = 0
+            for user_id in state:
+                end += len(user_id.encode())
+                self.ends.append(end)
+        size = 1024
+        while 2 * size < 3 * len(self.ends):
+            size *= 2
+        self.rehash(size)
+
+
+users = UserTable()
+
+
+def intern_user(user_id: str) -> int:
+    return users.intern(user_id)
+
+
+def choice_typecode(options) -> str:
+    return "B" if len(options) < 0xFF else "H" if len(options) < 0xFFFF else "L"
+
+
+class PollVotes:
+    """Votes of one poll. A choice is the option index + 1, 0 means the user has not voted.
+    version grows with every change of the poll or its votes, definition_version only with changes of the poll.
+
+    Votes are two parallel arrays sorted by user index, voters and their choices, 5 bytes per vote with fewer than
+    255 options. New users get the highest index, so their votes are appended."""
+
+    __slots__ = ("options", "option_indexes", "counts", "total", "voters", "choices", "version",
+                 "definition_version")
+
+    def __init__(self, options, version=0, definition_version=0):
+        self.options = list(dict.fromkeys(options))
+        self.option_indexes = {option: index for index, option in enumerate(self.options)}
+        self.counts = array("Q", bytes(8 * len(self.options)))
+        self.total = 0
+        self.voters = array("I")
+        self.choices = array(choice_typecode(self.options))
+        self.version = version
+        self.definition_version = definition_version
+
+    def __setstate__(self, state):
+        slots = state[1] if isinstance(state, tuple) else state
+        self.version = self.definition_version = 0
+        for name, value in slots.items():
+            if name not in ("sparse", "dense"):
+                setattr(self, name, value)
+        if "voters" not in slots:
+            # snapshot written when votes were a dict {user: choice} or an array indexed by user
+            votes = slots["sparse"].items() if slots.get("dense") is None else enumerate(slots["dense"])
+            votes = sorted((user, choice) for user, choice in votes if choice)
+            self.voters = array("I", (user for user, _ in votes))
+            self.choices = array(choice_typecode(self.options), (choice for _, choice in votes))
+
+    def copy(self) -> "PollVotes":
+        copy = PollVotes.__new__(PollVotes)
+        copy.options = self.options
+        copy.option_indexes = self.option_indexes
+        copy.counts = self.counts[:]
+        copy.total = self.total
+        copy.voters = self.voters[:]
+        copy.choices = self.choices[:]
+        copy.version = self.version
+        copy.definition_version = self.definition_version
+        return copy
+
+    def choice(self, option: str) -> int:
+        return self.option_indexes.get(option, -1) + 1
+
+    def position(self, user: int) -> int:
+        voters = self.voters
+        if not voters or user > voters[-1]:
+            return len(voters)
+        return bisect_left(voters, user)
+
+    def choice_of(self, user: int) -> int:
+        position = self.position(user)
+        return self.choices[position] if position < len(self.voters) and self.voters[position] == user else 0
+
+    def option_of(self, user: int) -> Optional[str]:
+        choice = self.choice_of(user)
+        return self.options[choice - 1] if choice else None
+
+    def set_choice(self, user: int, choice: int):
+        self.version += 1
+        position = self.position(user)
+        found = position < len(self.voters) and self.voters[position] == user
+        previous = self.choices[position] if found else 0
+        if previous:
+            self.counts[previous - 1] -= 1
+            self.total -= 1
+        if choice:
+            self.counts[choice - 1] += 1
+            self.total += 1
+
+        if found and choice:
+            self.choices[position] = choice
+        elif found:
+            del self.voters[position]
+            del self.choices[position]
+        elif choice:
+            self.voters.insert(position, user)
+            self.choices.insert(position, choice)
+
+    def results(self) -> Dict[str, int]:
+        return dict(zip(self.options, self.counts))
+
+    def items(self):
+        """(user_id, option) of every vote"""
+        for user, choice in zip(self.voters, self.choices):
+            yield users.user_id(user), self.options[choice - 1]
+
+
+class MemoryStorage:
+    """Polls as dicts {"question", "description", "options"} and their votes, kept in this process"""
+
+    def __init__(self):
+        self.polls: Dict[str, dict] = {}
+        self.votes: Dict[str, PollVotes] = {}
+        self.last_poll_id = 0
+        # sorted ids of all polls and, for every word of their questions, of the polls having it
+        self.order: List[int] = []
+        self.words: Dict[str, List[int]] = {}
+
+    def __len__(self):
+        return len(self.polls)
+
+    def list_polls(self, skip: int, limit: int, after: Optional[int] = None,
+                   query: Optional[str] = None) -> List[tuple]:
+        """Polls with id greater than after, skipping the first skip of them, whose question has all words of query"""
+        words = question_words(query) if query else set()
+        # a search walks the ids of its rarest word
+        ids = min((self.words.get(word, []) for word in words), key=len) if words else self.order
+        start = bisect_right(ids, after) if after is not None else 0
+        skip, limit = max(0, skip), max(0, limit)
+        if words:
+            matching = (poll_id for poll_id in islice(ids, start, None)
+                        if words <= question_words(self.polls[str(poll_id)]["question"]))
+            selected = list(islice(matching, skip, skip + limit))
+        else:
+            selected = ids[start + skip: start + skip + limit]
+        return [(str(poll_id), self.polls[str(poll_id)]) for poll_id in selected]
+
+    def index_poll(self, poll_id: str, question: str, add: bool):
+        key = int(poll_id)
+        for word in question_words(question):
+            ids = self.words.setdefault(word, [])
+            if add:
+                insort(ids, key)
+            else:
+                del ids[bisect_left(ids, key)]
+                if not ids:
+                    del self.words[word]
+
+    def get_poll(self, poll_id: str) -> Optional[dict]:
+        return self.polls.get(poll_id)
+
+    def create_poll(self, poll: dict, poll_id: Optional[str] = None) -> str:
+        # poll_id is only given when the write-ahead log is replayed
+        if poll_id is None:
+            poll_id = str(self.last_poll_id + 1)
+        self.last_poll_id = max(self.last_poll_id, int(poll_id))
+        self.polls[poll_id] = poll
+        self.votes[poll_id] = PollVotes(poll["options"])
+        # ids only grow, so this is an append
+        insort(self.order, int(poll_id))
+        self.index_poll(poll_id, poll["question"], add=True)
+        return poll_id
+
+    def update_poll(self, poll_id: str, changes: dict) -> dict:
+        votes = self.poll_votes(poll_id)
+        if votes.total:
+            raise VoteError("There are votes for this poll")
+
+        # update only if there are no votes
+        poll = {**self.polls[poll_id], **{key: value for key, value in changes.items() if value is not None}}
+        self.index_poll(poll_id, self.polls[poll_id]["question"], add=False)
+        self.index_poll(poll_id, poll["question"], add=True)
+        self.polls[poll_id] = poll
+        self.votes[poll_id] = PollVotes(poll["options"], votes.version + 1, votes.definition_version + 1)
+        return poll
+
+    def delete_poll(self, poll_id: str) -> bool:
+        if poll_id not in self.polls:
+            return False
+        self.index_poll(poll_id, self.polls[poll_id]["question"], add=False)
+        del self.order[bisect_left(self.order, int(poll_id))]
+        del self.polls[poll_id]
+        del self.votes[poll_id]
+        return True
+
+    def add_vote(self, poll_id: str, user_id: str, option: str):
+        votes = self.poll_votes(poll_id)
+        choice = votes.choice(option)
+        if not choice:
+            raise VoteError("Invalid option")
+
+        user = intern_user(user_id)
+        if votes.choice_of(user):
+            raise VoteError("User has already voted")
+        votes.set_choice(user, choice)
+
+    def update_vote(self, poll_id: str, user_id: str, option: str):
+        votes = self.poll_votes(poll_id)
+        choice = votes.choice(option)
+        if not choice:
+            raise VoteError("Invalid option")
+
+        user = users.get(user_id)
+        if user is None or not votes.choice_of(user):
+            raise VoteError("User has not voted yet")
+        votes.set_choice(user, choice)
+
+    def delete_vote(self, poll_id: str, user_id: str, option: str):
+        votes = self.poll_votes(poll_id)
+        if not votes.choice(option):
+            raise VoteError("Invalid option")
+
+        user = users.get(user_id)
+        if user is None or not votes.choice_of(user):
+            raise VoteError("No vote found for this user")
+        votes.set_choice(user, 0)
+
+    def apply_votes(self, votes: List[tuple]) -> list:
+        """votes are (action, poll_id, user_id, option) with action in VOTE_ACTIONS,
+        returns None or the PollNotFound / VoteError of every vote"""
+        operations = {"add": self.add_vote, "update": self.update_vote, "delete": self.delete_vote}
+        errors = []
+        for action, poll_id, user_id, option in votes:
+            try:
+                operations[action](poll_id, user_id, option)
+                errors.append(None)
+            except (PollNotFound, VoteError) as error:
+                errors.append(error)
+        return errors
+
+    def results(self, poll_id: str) -> Dict[str, int]:
+        return self.poll_votes(poll_id).results()
+
+    def version(self, poll_id: str) -> Optional[int]:
+        votes = self.votes.get(poll_id)
+        return votes.version if votes is not None else None
+
+    def definition_version(self, poll_id: str) -> Optional[int]:
+        votes = self.votes.get(poll_id)
+        return votes.definition_version if votes is not None else None
+
+    def dump(self) -> dict:
+        """Copy of the whole state, which can be pickled in another thread while this one keeps changing"""
+        votes = {poll_id: poll_votes.copy() for poll_id, poll_votes in self.votes.items()}
+        return {"last_poll_id": self.last_poll_id, "polls": dict(self.polls), "votes": votes, "users": users.dump()}
+
+    def load(self, state: dict):
+        self.last_poll_id = state["last_poll_id"]
+        self.polls = state["polls"]
+        self.votes = state["votes"]
+        users.load(state["users"] if "users" in state else state["user_ids"])
+
+        self.order = sorted(map(int, self.polls))
+        self.words = {}
+        for poll_id in self.order:
+            for word in question_words(self.polls[str(poll_id)]["question"]):
+                self.words.setdefault(word, []).append(poll_id)
+
+    def poll_votes(self, poll_id: str) -> PollVotes:
+        votes = self.votes.get(poll_id)
+        if votes is None:
+            raise PollNotFound(poll_id)
+        return votes
+
+
+WORD_COUNT_LIMIT = 1000
+# a transaction waits this long for the write lock of another worker, the event loop is blocked meanwhile
+BUSY_TIMEOUT = 20  # milliseconds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS polls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    question TEXT NOT NULL,
+    description TEXT,
+    options TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    definition_version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS options (
+    poll_id INTEGER NOT NULL REFERENCES polls (id) ON DELETE CASCADE,
+    option TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    votes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (poll_id, option)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS poll_words (
+    word TEXT NOT NULL,
+    poll_id INTEGER NOT NULL REFERENCES polls (id) ON DELETE CASCADE,
+    PRIMARY KEY (word, poll_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS poll_words_poll ON poll_words (poll_id);
+CREATE TABLE IF NOT EXISTS votes (
+    poll_id INTEGER NOT NULL REFERENCES polls (id) ON DELETE CASCADE,
+    user_id TEXT NOT NULL,
+    option TEXT NOT NULL,
+    PRIMARY KEY (poll_id, user_id)
+) WITHOUT ROWID;
+"""
+
+
+def row_id(poll_id: str) -> Optional[int]:
+    # "01" is not the same poll as "1"
+    if poll_id.isascii() and poll_id.isdigit() and str(int(poll_id)) == poll_id:
+        return int(poll_id)
+    return None
+
+
+class SqliteStorage:
+    """Same interface as MemoryStorage, kept in one SQLite database in WAL mode, so several worker processes
+    can share polls, votes and poll ids. Every mutation is one transaction holding the write lock from its start,
+    the primary key of votes keeps one vote per user."""
+
+    def __init__(self, path: str):
+        # only used from the thread of the event loop, which is not always the thread that imported the app
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=10, check_same_thread=False)
+        # the schema is set up before the app serves requests, it can wait for other workers
+        self.db.execute("PRAGMA busy_timeout = 10000")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(polls)")}
+        for column in ("version", "definition_version"):
+            if column not in columns:
+                try:
+                    self.db.execute(f"ALTER TABLE polls ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    # added by another worker in the meantime
+                    pass
+        # databases created before the search have polls but no words
+        if not self.db.execute("SELECT EXISTS (SELECT 1 FROM poll_words)").fetchone()[0] and self:
+            self.transaction(self.index_all_polls)
+        self.db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT}")
+
+    def transaction(self, operation):
+        # BEGIN IMMEDIATE takes the write lock right away, so checks and writes of concurrent workers never interleave
+        try:
+            self.db.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as error:
+            if "locked" in str(error) or "busy" in str(error):
+                raise StorageBusy(str(error))
+            raise
+        try:
+            result = operation()
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return result
+
+    def close(self):
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM polls").fetchone()[0]
+
+    def __bool__(self):
+        # COUNT(*) reads the whole table
+        return self.db.execute("SELECT EXISTS (SELECT 1 FROM polls)").fetchone()[0] == 1
+
+    @staticmethod
+    def poll_from_row(row) -> dict:
+        return {"question": row[0], "description": row[1], "options": json.loads(row[2])}
+
+    def list_polls(self, skip: int, limit: int, after: Optional[int] = None,
+                   query: Optional[str] = None) -> List[tuple]:
+        words = sorted(question_words(query), key=lambda word: (self.word_count(word), word)) if query else []
+        if words:
+            # a search walks the index of its rarest word from after on and looks the other words up for each poll
+            sql = ("SELECT polls.id, question, description, options FROM poll_words "
+                   "JOIN polls ON polls.id = poll_words.poll_id WHERE poll_words.word = ? AND poll_words.poll_id > ?")
+            for _ in words[1:]:
+                sql += (" AND EXISTS (SELECT 1 FROM poll_words AS other "
+                        "WHERE other.word = ? AND other.poll_id = poll_words.poll_id)")
+            sql += " ORDER BY poll_words.poll_id LIMIT ? OFFSET ?"
+            params = (words[0], after if after is not None else -1, *words[1:], max(0, limit), max(0, skip))
+        else:
+            sql = "SELECT id, question, description, options FROM polls WHERE id > ? ORDER BY id LIMIT ? OFFSET ?"
+            params = (after if after is not None else -1, max(0, limit), max(0, skip))
+        return [(str(row[0]), self.poll_from_row(row[1:])) for row in self.db.execute(sql, params)]
+
+    def word_count(self, word: str) -> int:
+        # counting stops at WORD_COUNT_LIMIT, common words do not need to be told apart
+        return self.db.execute("SELECT COUNT(*) FROM (SELECT 1 FROM poll_words WHERE word = ? LIMIT ?)",
+                               (word, WORD_COUNT_LIMIT)).fetchone()[0]
+
+    def index_all_polls(self):
+        if self.db.execute("SELECT EXISTS (SELECT 1 FROM poll_words)").fetchone()[0]:
+            # indexed by another worker in the meantime
+            return
+        self.db.executemany("INSERT INTO poll_words (word, poll_id) VALUES (?, ?)",
+                            [(word, key) for key, question in self.db.execute("SELECT id, question FROM polls")
+                             for word in question_words(question)])
+
+    def index_poll(self, key: int, question: str):
+        self.db.execute("DELETE FROM poll_words WHERE poll_id = ?", (key,))
+        self.db.executemany("INSERT INTO poll_words (word, poll_id) VALUES (?, ?)",
+                            [(word, key) for word in question_words(question)])
+
+    def get_poll(self, poll_id: str) -> Optional[dict]:
+        row = self.db.execute("SELECT question, description, options FROM polls WHERE id = ?",
+                              (row_id(poll_id),)).fetchone()
+        return self.poll_from_row(row) if row else None
+
+    def create_poll(self, poll: dict) -> str:
+        def create():
+            poll_id = self.db.execute("INSERT INTO polls (question, description, options) VALUES (?, ?, ?)",
+                                      (poll["question"], poll["description"], json.dumps(poll["options"]))).lastrowid
+            self.insert_options(poll_id, poll["options"])
+            self.index_poll(poll_id, poll["question"])
+            return str(poll_id)
+
+        return self.transaction(create)
+
+    def insert_options(self, poll_id: int, options: List[str]):
+        self.db.executemany("INSERT INTO options (poll_id, option, position) VALUES (?, ?, ?)",
+                            [(poll_id, option, position) for position, option in enumerate(dict.fromkeys(options))])
+
+    def update_poll(self, poll_id: str, changes: dict) -> dict:
+        def update():
+            key = self.check_poll(poll_id)
+            if self.db.execute("SELECT 1 FROM votes WHERE poll_id = ? LIMIT 1", (key,)).fetchone():
+                raise VoteError("There are votes for this poll")
+
+            # update only if there are no votes
+            poll = {**self.get_poll(poll_id), **{field: value for field, value in changes.items() if value is not None}}
+            self.db.execute("UPDATE polls SET question = ?, description = ?, options = ?, version = version + 1, "
+                            "definition_version = definition_version + 1 WHERE id = ?",
+                            (poll["question"], poll["description"], json.dumps(poll["options"]), key))
+            self.db.execute("DELETE FROM options WHERE poll_id = ?", (key,))
+            self.insert_options(key, poll["options"])
+            self.index_poll(key, poll["question"])
+            return poll
+
+        return self.transaction(update)
+
+    def delete_poll(self, poll_id: str) -> bool:
+        return self.transaction(
+            lambda: self.db.execute("DELETE FROM polls WHERE id = ?", (row_id(poll_id),)).rowcount > 0)
+
+    def add_vote(self, poll_id: str, user_id: str, option: str):
+        self.transaction(lambda: self.insert_vote(poll_id, user_id, option))
+
+    def update_vote(self, poll_id: str, user_id: str, option: str):
+        self.transaction(lambda: self.change_vote(poll_id, user_id, option))
+
+    def delete_vote(self, poll_id: str, user_id: str, option: str):
+        self.transaction(lambda: self.remove_vote(poll_id, user_id, option))
+
+    def apply_votes(self, votes: List[tuple]) -> list:
+        """Like MemoryStorage.apply_votes, all votes in one transaction, options of every poll are read once"""
+        operations = {"add": self.insert_vote, "update": self.change_vote, "delete": self.remove_vote}
+        options = {}
+
+        def apply():
+            errors = []
+            for action, poll_id, user_id, option in votes:
+                try:
+                    operations[action](poll_id, user_id, option, options)
+                    errors.append(None)
+                except (PollNotFound, VoteError) as error:
+                    errors.append(error)
+            return errors
+
+        return self.transaction(apply)
+
+    def insert_vote(self, poll_id: str, user_id: str, option: str, options: Optional[dict] = None):
+        key = self.check_option(poll_id, option, options)
+        try:
+            self.db.execute("INSERT INTO votes (poll_id, user_id, option) VALUES (?, ?, ?)", (key, user_id, option))
+        except sqlite3.IntegrityError:
+            raise VoteError("User has already voted")
+        self.count_vote(key, option, 1)
+        self.touch(key)
+
+    def change_vote(self, poll_id: str, user_id: str, option: str, options: Optional[dict] = None):
+        key = self.check_option(poll_id, option, options)
+        previous_option = self.option_of(key, user_id, "User has not voted yet")
+        self.db.execute("UPDATE votes SET option = ? WHERE poll_id = ? AND user_id = ?", (option, key, user_id))
+        self.count_vote(key, previous_option, -1)
+        self.count_vote(key, option, 1)
+        self.touch(key)
+
+    def remove_vote(self, poll_id: str, user_id: str, option: str, options: Optional[dict] = None):
+        key = self.check_option(poll_id, option, options)
+        previous_option = self.option_of(key, user_id, "No vote found for this user")
+        self.db.execute("DELETE FROM votes WHERE poll_id = ? AND user_id = ?", (key, user_id))
+        self.count_vote(key, previous_option, -1)
+        self.touch(key)
+
+    def results(self, poll_id: str) -> Dict[str, int]:
+        key = self.check_poll(poll_id)
+        return dict(self.db.execute("SELECT option, votes FROM options WHERE poll_id = ? ORDER BY position", (key,)))
+
+    def check_poll(self, poll_id: str) -> int:
+        key = row_id(poll_id)
+        if key is None or not self.db.execute("SELECT 1 FROM polls WHERE id = ?", (key,)).fetchone():
+            raise PollNotFound(poll_id)
+        return key
+
+    def check_option(self, poll_id: str, option: str, options: Optional[dict] = None) -> int:
+        """options caches {poll_id: (key, set of options)} within one transaction"""
+        if options is None:
+            key = self.check_poll(poll_id)
+            if not self.db.execute("SELECT 1 FROM options WHERE poll_id = ? AND option = ?", (key, option)).fetchone():
+                raise VoteError("Invalid option")
+            return key
+
+        if poll_id not in options:
+            key = self.check_poll(poll_id)
+            options[poll_id] = key, {row[0] for row in self.db.execute("SELECT option FROM options WHERE poll_id = ?",
+                                                                       (key,))}
+        key, known = options[poll_id]
+        if option not in known:
+            raise VoteError("Invalid option")
+        return key
+
+    def option_of(self, key: int, user_id: str, error: str) -> str:
+        row = self.db.execute("SELECT option FROM votes WHERE poll_id = ? AND user_id = ?", (key, user_id)).fetchone()
+        if row is None:
+            raise VoteError(error)
+        return row[0]
+
+    def version(self, poll_id: str) -> Optional[int]:
+        row = self.db.execute("SELECT version FROM polls WHERE id = ?", (row_id(poll_id),)).fetchone()
+        return row[0] if row else None
+
+    def definition_version(self, poll_id: str) -> Optional[int]:
+        row = self.db.execute("SELECT definition_version FROM polls WHERE id = ?", (row_id(poll_id),)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, key: int):
+        self.db.execute("UPDATE polls SET version = version + 1 WHERE id = ?", (key,))
+
+    def count_vote(self, key: int, option: str, change: int):
+        self.db.execute("UPDATE options SET votes = votes + ? WHERE poll_id = ? AND option = ?", (change, key, option))
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+
+import persistence
+from persistence import Journal
+from storage import MemoryStorage
+
+POLL = {"question": "Favourite pizza", "description": None, "options": ["Margherita", "Hawaii"]}
+
+
+def reopen(directory):
+    async def run():
+        storage = MemoryStorage()
+        journal = Journal(storage, directory)
+        journal.open()
+        journal.stopped.set()
+        await journal.snapshots
+        journal.file.close()
+        return storage
+
+    return asyncio.run(run())
+
+
+def crash(journal):
+    """Stop the journal like a killed server would, without the final snapshot"""
+    journal.stopped.set()
+    journal.snapshots.cancel()
+    journal.file.close()
+
+
+def test_rotate_during_write(tmp_path, monkeypatch):
+    write_lines = persistence.write_lines
+
+    def slow_write_lines(file, lines):
+        time.sleep(0.2)
+        write_lines(file, lines)
+
+    monkeypatch.setattr(persistence, "write_lines", slow_write_lines)
+
+    async def run():
+        storage = MemoryStorage()
+        journal = Journal(storage, str(tmp_path))
+        journal.open()
+        poll_id = storage.create_poll(dict(POLL))
+        written = journal.append("create", poll_id, POLL)
+        await asyncio.sleep(0.05)
+        # the batch is in the executor now, the snapshot rotates to a new segment under it
+        await journal.snapshot()
+        await asyncio.wait_for(written, 2)
+
+        storage.add_vote(poll_id, "alice", "Hawaii")
+        await asyncio.wait_for(journal.append("vote", poll_id, "alice", "Hawaii"), 2)
+        assert journal.flushing is None
+        crash(journal)
+        return poll_id
+
+    poll_id = asyncio.run(run())
+    storage = reopen(str(tmp_path))
+    assert storage.get_poll(poll_id) == POLL
+    assert storage.results(poll_id) == {"Margherita": 0, "Hawaii": 1}
+
+
+def test_failed_write_fails_waiters(tmp_path, monkeypatch):
+    def broken_write_lines(file, lines):
+        raise ValueError("flush of closed file")
+
+    async def run():
+        journal = Journal(MemoryStorage(), str(tmp_path))
+        journal.open()
+        monkeypatch.setattr(persistence, "write_lines", broken_write_lines)
+        written = journal.append("delete", "1")
+        try:
+            await asyncio.wait_for(written, 2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("the write did not fail")
+        assert journal.flushing is None
+
+        monkeypatch.undo()
+        await asyncio.wait_for(journal.append("delete", "2"), 2)
+        crash(journal)
+
+    asyncio.run(run())
+
+
+def test_replay_after_snapshot(tmp_path):
+    async def run():
+        storage = MemoryStorage()
+        journal = Journal(storage, str(tmp_path))
+        journal.open()
+        first = storage.create_poll(dict(POLL))
+        await journal.append("create", first, POLL)
+        storage.add_vote(first, "alice", "Margherita")
+        await journal.append("vote", first, "alice", "Margherita")
+        await journal.snapshot()
+
+        # logged after the snapshot, only in the new segment
+        second = storage.create_poll(dict(POLL))
+        await journal.append("create", second, POLL)
+        storage.update_vote(first, "alice", "Hawaii")
+        await journal.append("revote", first, "alice", "Hawaii")
+        storage.add_vote(second, "bob", "Margherita")
+        await journal.append("vote", second, "bob", "Margherita")
+        crash(journal)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert len(persistence.list_segments(str(tmp_path))) == 1
+    assert os.path.exists(os.path.join(str(tmp_path), persistence.SNAPSHOT_FILE))
+
+    storage = reopen(str(tmp_path))
+    assert len(storage) == 2
+    assert storage.results(first) == {"Margherita": 0, "Hawaii": 1}
+    assert storage.results(second) == {"Margherita": 1, "Hawaii": 0}
+
+    # a new poll does not reuse an id of a replayed one
+    assert storage.create_poll(dict(POLL)) == str(int(second) + 1)